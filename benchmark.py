@@ -0,0 +1,166 @@
+import argparse
+import time
+
+import numpy as np
+
+
+def _time(fn, repeats):
+    """
+    :return: mean time of one call in ms (first call is warm-up)
+    """
+    fn()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - start) / repeats * 1000
+
+
+def benchmark_warp(size, channels, batch_size, repeats, device=None):
+    """
+    Compares methods of Warp layer on random inputs (flow also points out of image)
+
+    :param tuple size: (height, width)
+    :param int channels:
+    :param int batch_size:
+    :param int repeats:
+    :param str device: e.g. /cpu:0 (None for default)
+    """
+    import tensorflow as tf
+    from models.layers.warp import Warp
+
+    img = np.random.rand(batch_size, size[0], size[1], channels).astype(np.float32)
+    flow = (np.random.randn(batch_size, size[0], size[1], 2) * 10).astype(np.float32)
+
+    print("-- warp %dx%dx%d, batch %d, %d repeats" % (size[0], size[1], channels, batch_size, repeats))
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.device(device):
+        img_var = tf.Variable(img)
+        flow_var = tf.Variable(flow)
+        outputs = {method: Warp.warp(img_var, flow_var, size, method) for method in Warp.METHODS}
+
+    with tf.Session(graph=graph) as sess:
+        sess.run(tf.variables_initializer([img_var, flow_var]))
+        expected = sess.run(outputs['gather_nd'])
+
+        for method in Warp.METHODS:
+            out = sess.run(outputs[method])
+            # borders differ for resampler (zero padding)
+            inner = np.s_[:, 20:-20, 20:-20, :]
+            diff = np.max(np.abs(out - expected))
+            inner_diff = np.max(np.abs(out[inner] - expected[inner]))
+            ms = _time(lambda: sess.run(outputs[method].op), repeats)
+            print("   %-10s %8.2f ms   max diff %g (inner %g)" % (method, ms, diff, inner_diff))
+
+    ms = _time(lambda: Warp.np_warp(img, flow), repeats)
+    print("   %-10s %8.2f ms" % ('np_warp', ms))
+
+
+def _normalize_reference(rgb, target_size, mean, std):
+    """
+    Previous preprocessing: resize, min-max normalization to float32 and standardization in separate passes
+    """
+    import cv2
+
+    rgb = cv2.resize(rgb, target_size[::-1])
+    norm_image = np.zeros_like(rgb, dtype=np.float32)
+    cv2.normalize(rgb, norm_image, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+    norm_image -= mean
+    norm_image /= std
+    return norm_image
+
+
+def benchmark_preprocess(size, repeats, frame_size=(1024, 2048)):
+    """
+    Compares previous and fused preprocessing of one full-size uint8 frame to normalized tensor
+
+    :param tuple size: target (height, width)
+    :param int repeats:
+    :param tuple frame_size: (height, width) of decoded frame (Cityscapes)
+    """
+    import config
+    from generator import CityscapesGenerator
+
+    datagen = CityscapesGenerator(config.data_path())
+    mean, std = datagen._mean_std()
+    frame = np.random.randint(0, 256, frame_size + (3,)).astype(np.uint8)
+
+    print("-- preprocess %dx%d -> %dx%d, %d repeats" % (frame_size[0], frame_size[1], size[0], size[1], repeats))
+
+    expected = _normalize_reference(frame, size, mean, std)
+    ms = _time(lambda: _normalize_reference(frame, size, mean, std), repeats)
+    print("   %-16s %8.2f ms" % ('reference', ms))
+
+    for normalization in datagen.NORMALIZATIONS:
+        for dtype in ['float32', 'float16']:
+            datagen.set_normalization(normalization)
+            datagen.set_input_dtype(dtype)
+            out = datagen.normalize(frame, size)
+            ms = _time(lambda: datagen.normalize(frame, size), repeats)
+            diff = np.max(np.abs(out.astype(np.float32) - expected))
+            print("   %-16s %8.2f ms   max diff %g" % (normalization + ' ' + dtype, ms, diff))
+
+
+if __name__ == '__main__':
+    import config
+
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Micro-benchmarks')
+
+        parser.add_argument(
+            'what',
+            help='What to benchmark [warp, preprocess]',
+            nargs='?',
+            default='warp'
+        )
+
+        parser.add_argument(
+            '-r', '--repeats',
+            help='Number of repeats',
+            default=20
+        )
+
+        parser.add_argument(
+            '-b', '--batch',
+            help='Batch size',
+            default=4
+        )
+
+        parser.add_argument(
+            '-c', '--channels',
+            help='Number of channels of warped tensor',
+            default=32
+        )
+
+        parser.add_argument(
+            '--cpu',
+            action='store_true',
+            help='Run on CPU',
+            default=False
+        )
+
+        parser.add_argument(
+            '--height',
+            help='Height',
+            default=config.target_size()[0]
+        )
+
+        parser.add_argument(
+            '--width',
+            help='Width',
+            default=config.target_size()[1]
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+    size = int(args.height), int(args.width)
+
+    if args.what == 'warp':
+        benchmark_warp(size, int(args.channels), int(args.batch), int(args.repeats), '/cpu:0' if args.cpu else None)
+    elif args.what == 'preprocess':
+        benchmark_preprocess(size, int(args.repeats))
+    else:
+        raise Exception("Unknown benchmark %s!" % args.what)
@@ -119,13 +119,14 @@ class CustomTensorBoard(TensorBoard):
     def on_epoch_end(self, epoch, logs=None):
         logs = logs or {}
 
-        if 'out_mean_iou' in logs:
-            out_mean_iou = logs['out_mean_iou']
-            del logs['out_mean_iou']
-            val_out_mean_iou = logs['val_out_mean_iou']
-            del logs['val_out_mean_iou']
+        for metric_name in ['out_mean_iou', 'out_sparse_mean_iou']:
+            if metric_name in logs:
+                out_mean_iou = logs[metric_name]
+                del logs[metric_name]
+                val_out_mean_iou = logs['val_' + metric_name]
+                del logs['val_' + metric_name]
 
-            logs.update({"mean_iou": out_mean_iou, "val_mean_iou": val_out_mean_iou})
+                logs.update({"mean_iou": out_mean_iou, "val_mean_iou": val_out_mean_iou})
 
         if self._track_lr:
             # TODO not working on multi gpus :(
@@ -151,6 +152,41 @@ class CustomTensorBoard(TensorBoard):
         super(CustomTensorBoard, self).on_epoch_end(epoch, logs)
 
 
+class ConfusionMatrixCallback(Callback):
+    """
+    On epoch end evaluates validation data by confusion matrix (exact mIoU over the whole split)
+    and adds `val_miou` to logs (put it before callbacks which should see it).
+    It is a second pass over validation data (after keras validation) over its own sequence,
+    validation data of fit_generator is being prefetched by its enqueuer meanwhile.
+    The first output of the graph for training is scored against its ground truth, i.e. at resolution of training
+    labels ('out' of ICNet at 1/4 of input), evaluate.py scores the inference output at target size.
+    """
+
+    def __init__(self, sequence, n_classes, ignored_classes=None, class_names=None):
+        """
+        :param keras.utils.Sequence sequence: validation batches (own sequence, not validation_data of fit_generator),
+            every sample once (see DataSequence partial)
+        :param int n_classes:
+        :param list ignored_classes: class indexes ignored in evaluation
+        :param list class_names:
+        """
+        from evaluation import ConfusionMatrix
+
+        self.sequence = sequence
+        self.confusion_matrix = ConfusionMatrix(n_classes, ignored_classes, class_names)
+        super(ConfusionMatrixCallback, self).__init__()
+
+    def on_epoch_end(self, epoch, logs=None):
+        from evaluation import evaluate
+
+        logs = logs if logs is not None else {}
+
+        self.confusion_matrix.reset()
+        evaluate(self.model, self.sequence, self.confusion_matrix, verbose=False)
+        print("-- val mIoU (confusion matrix) %.4f, %.2f fps" % (self.confusion_matrix.mean_iou(), self.confusion_matrix.fps()))
+        logs['val_miou'] = self.confusion_matrix.mean_iou()
+
+
 class SaveLastTrainedEpochCallback(callbacks.Callback):
     """
     On epoch end saves currently finished epoch to file
@@ -39,6 +39,15 @@ def target_size():
     return 256, 512  # /4w
 
 
+def flow_cache_path():
+    """
+    Optical flow cache directory from os environment $FLOW_CACHE (None if not set)
+
+    :rtype str:
+    """
+    return os.environ.get('FLOW_CACHE')
+
+
 def weights_path():
     try:
         weights_path = os.environ['WEIGHTS']
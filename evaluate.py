@@ -0,0 +1,279 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+import config
+from evaluation import ConfusionMatrix
+
+
+def evaluate_checkpoints(models, sequence, confusion_matrices, workers=4, max_queue=10, use_multiprocessing=False, output_index=0):
+    """
+    Every batch is loaded once (in parallel by enqueuer) and predicted by all models (checkpoints)
+
+    :param list models: list of BaseModel with loaded weights
+    :param keras.utils.Sequence sequence: batches in order (not shuffled)
+    :param list confusion_matrices: ConfusionMatrix for every model
+    :param int workers:
+    :param int max_queue:
+    :param bool use_multiprocessing:
+    :param int output_index: which output (and ground truth) is evaluated for models with more outputs
+    :return list: latencies (seconds of prediction of a single image, first image of every batch) for every model
+    """
+    from keras.utils import OrderedEnqueuer
+
+    latencies = [[] for _ in models]
+    steps = len(sequence)
+
+    enqueuer = OrderedEnqueuer(sequence, use_multiprocessing=use_multiprocessing, shuffle=False)
+    enqueuer.start(workers=workers, max_queue_size=max_queue)
+    try:
+        batches = enqueuer.get()
+        for i in range(steps):
+            x, y = next(batches)
+            if isinstance(y, list):
+                y = y[output_index]
+
+            for model, confusion_matrix, latency in zip(models, confusion_matrices, latencies):
+                start = time.time()
+                prediction = model.k.predict_on_batch(x)
+                elapsed = time.time() - start
+
+                if isinstance(prediction, list):
+                    prediction = prediction[output_index]
+
+                confusion_matrix.update(y, prediction)
+                confusion_matrix.frames += len(prediction)
+                confusion_matrix.predict_time += elapsed
+
+                # batch time divided by its size is throughput, latency is time of a single image
+                start = time.time()
+                model.k.predict_on_batch([arr[:1] for arr in x])
+                latency.append(time.time() - start)
+
+            if (i + 1) % 50 == 0 or i + 1 == steps:
+                print("-- evaluated %d/%d batches, mIoU %s" % (
+                    i + 1, steps, ', '.join('%.4f' % cm.mean_iou() for cm in confusion_matrices)))
+    finally:
+        enqueuer.stop()
+
+    return latencies
+
+
+def latency_percentiles(latency, percentiles=(50, 90, 99)):
+    """
+    :param list latency: seconds of single image predictions
+    :return list: percentiles in ms
+    """
+    if len(latency) == 0:
+        return [0.] * len(percentiles)
+    return [float(p) * 1000 for p in np.percentile(latency, percentiles)]
+
+
+if __name__ == '__main__':
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Evaluate trained checkpoints')
+
+        parser.add_argument(
+            '-m', '--model',
+            help='Model to evaluate (as in train.py)',
+            default='icnet'
+        )
+
+        parser.add_argument(
+            '-w', '--weights',
+            help='Weights of checkpoints (all are evaluated in one pass over data)',
+            nargs='+',
+            required=True
+        )
+
+        parser.add_argument(
+            '-s', '--split',
+            help='Split [val, test, train]',
+            default='val'
+        )
+
+        parser.add_argument(
+            '-b', '--batch',
+            help='Batch size',
+            default=4
+        )
+
+        parser.add_argument(
+            '--workers',
+            help='Number of workers loading batches',
+            default=4
+        )
+
+        parser.add_argument(
+            '--queue',
+            help='Max size of queue of loaded batches',
+            default=10
+        )
+
+        parser.add_argument(
+            '--multiprocess',
+            action='store_true',
+            help='Workers are processes',
+            default=False
+        )
+
+        parser.add_argument(
+            '-o', '--optic',
+            help='Optical flow',
+            default='farn'
+        )
+
+        parser.add_argument(
+            '--flow_cache',
+            help='Directory of optical flow cache',
+            default=config.flow_cache_path()
+        )
+
+        parser.add_argument(
+            '--flow_cache_storage',
+            help='Storage of cached optical flow [float32, float16, quantized]',
+            default='float16'
+        )
+
+        parser.add_argument(
+            '--packed',
+            help='Directory of packed dataset (see pack_dataset.py)',
+            default=None
+        )
+
+        parser.add_argument(
+            '-d', '--debug',
+            help='Just debug (number to pick from dataset)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--features',
+            help='Directory of cached features of previous frames for warp models (see precompute_features.py)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--norm',
+            help='Normalization of frames used in training [minmax, fixed]',
+            default='minmax'
+        )
+
+        parser.add_argument(
+            '--dtype',
+            help='Comma separated input types of models [float32, float16], '
+                 'more types compare accuracy of every checkpoint on the same float32 batches',
+            default='float32'
+        )
+
+        parser.add_argument(
+            '--gid',
+            help='GPU id',
+            default=None
+        )
+
+        parser.add_argument(
+            '--height',
+            help='Target image height',
+            default=config.target_size()[0]
+        )
+
+        parser.add_argument(
+            '--width',
+            help='Target image width',
+            default=config.target_size()[1]
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+
+    if args.gid is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gid
+
+    from factory import create_generator, create_model
+    from generator import BatchRing, FlowCache
+    from models import ICNetWarp, SegNetWarp
+
+    dataset_path = config.data_path()
+    target_size = int(args.height), int(args.width)
+    debug_samples = int(args.debug)
+
+    flow_cache = None
+    if args.flow_cache is not None:
+        flow_cache = FlowCache(args.flow_cache, storage=args.flow_cache_storage)
+
+    # labels as class indexes are enough for confusion matrix,
+    # labels at target size for output of inference graph (out_full of ICNet instead of 1/4 resolution 'out')
+    datagen = create_generator(args.model, dataset_path, debug_samples, args.optic, sparse_labels=True, flow_cache=flow_cache)
+    datagen.use_full_labels()
+    datagen.set_normalization(args.norm)
+    dtypes = args.dtype.split(',')
+    # lower precision models get float32 batches converted when fed, so all are evaluated on the same data
+    datagen.set_input_dtype('float32' if 'float32' in dtypes else dtypes[0])
+    if args.packed is not None:
+        datagen.load_packed(args.packed)
+    datagen.load_files()
+
+    # evaluated on graph for inference (first output at target size)
+    models = []
+    names = []
+    for weights in args.weights:
+        for dtype in dtypes:
+            print("-- loading %s (%s)" % (weights, dtype))
+            model = create_model(args.model, target_size, datagen.n_classes, debug_samples, for_training=False,
+                                 input_dtype=dtype)
+            models.append(model.load_for_inference(weights))
+            names.append(weights if len(dtypes) == 1 else '%s [%s]' % (weights, dtype))
+
+    # warp models for inference take features of previous frame as inputs
+    if isinstance(models[0], (SegNetWarp, ICNetWarp)):
+        if args.features is None:
+            raise Exception("Features of previous frames must be set for warp model %s (--features)" % args.model)
+        datagen.load_features(args.features, models[0].prev_feature_names(), target_size)
+
+    # batches are built into reused buffers, ring is larger than number of batches kept by enqueuer,
+    # every sample is evaluated once (smaller last batch)
+    buffers = BatchRing.enqueuer_size(int(args.queue), int(args.workers))
+    sequence = datagen.sequence(args.split, int(args.batch), target_size, shuffle=False, buffers=buffers, partial=True)
+    sequence.attach_enqueuer(int(args.queue), int(args.workers))
+    confusion_matrices = [
+        ConfusionMatrix(datagen.n_classes, datagen.ignored_classes, datagen.class_names)
+        for _ in models
+    ]
+
+    print("-- evaluating %d checkpoints on %s (%d batches)" % (len(models), args.split, len(sequence)))
+    latencies = evaluate_checkpoints(
+        models,
+        sequence,
+        confusion_matrices,
+        workers=int(args.workers),
+        max_queue=int(args.queue),
+        use_multiprocessing=args.multiprocess
+    )
+
+    for name, confusion_matrix, latency in zip(names, confusion_matrices, latencies):
+        print("---------------")
+        print("-- %s" % name)
+        confusion_matrix.summary()
+        print("-- latency of single image p50 %.2f ms, p90 %.2f ms, p99 %.2f ms" % tuple(latency_percentiles(latency)))
+
+    print("---------------")
+    for name, confusion_matrix, latency in zip(names, confusion_matrices, latencies):
+        print("%.4f mIoU  %7.2f fps  p50 %6.2f ms  %s" % (
+            confusion_matrix.mean_iou(), confusion_matrix.fps(), latency_percentiles(latency)[0], name))
+
+    if 'float32' in dtypes and len(dtypes) > 1:
+        # accuracy check of lower precision inputs against float32 baseline
+        print("---------------")
+        baseline_index = dtypes.index('float32')
+        for i, weights in enumerate(args.weights):
+            baseline = confusion_matrices[i * len(dtypes) + baseline_index].mean_iou()
+            for j, dtype in enumerate(dtypes):
+                if j != baseline_index:
+                    miou = confusion_matrices[i * len(dtypes) + j].mean_iou()
+                    print("%s mIoU %.4f (float32 %.4f, difference %+.4f)  %s" % (dtype, miou, baseline, miou - baseline, weights))
@@ -0,0 +1,145 @@
+import time
+
+import numpy as np
+
+
+class ConfusionMatrix:
+    """
+    Confusion matrix accumulated batch by batch over the whole split (constant memory).
+    Rows are ground truth classes, columns predicted classes.
+    Pixels with ground truth of ignored class (ignoreInEval) are not counted,
+    prediction of ignored class on other pixels counts as error.
+    """
+
+    def __init__(self, n_classes, ignored_classes=None, class_names=None):
+        """
+        :param int n_classes:
+        :param list ignored_classes: class indexes ignored in evaluation
+        :param list class_names: names for summary (optional)
+        """
+        self.n_classes = n_classes
+        self.ignored_classes = sorted(set(ignored_classes or []))
+        self.class_names = class_names or [str(i) for i in range(n_classes)]
+
+        self.evaluated = np.ones(n_classes, dtype=np.bool_)
+        self.evaluated[self.ignored_classes] = False
+
+        self.reset()
+
+    def reset(self):
+        self.matrix = np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+        self.frames = 0
+        self.predict_time = 0.
+
+    def to_classes(self, tensor):
+        """
+        :param tensor: one-hot or probabilities (..., n_classes) or class indexes (..., 1)
+        :return: class indexes (...)
+        """
+        if tensor.shape[-1] == 1:
+            return tensor[..., 0]
+        return np.argmax(tensor, axis=-1)
+
+    def update(self, y_true, y_pred):
+        """
+        :param y_true: ground truth batch, one-hot (batch, height, width, n_classes) or sparse (batch, height, width, 1)
+        :param y_pred: predicted probabilities (batch, height, width, n_classes)
+        """
+        true = self.to_classes(y_true).ravel().astype(np.int64)
+        pred = self.to_classes(y_pred).ravel().astype(np.int64)
+
+        valid = self.evaluated[true]
+        counts = np.bincount(true[valid] * self.n_classes + pred[valid], minlength=self.n_classes ** 2)
+        self.matrix += counts.reshape(self.n_classes, self.n_classes)
+
+    def per_class_iou(self):
+        """
+        :return: IoU of classes (nan for ignored classes and classes which are not in ground truth nor prediction)
+        """
+        tp = np.diag(self.matrix).astype(np.float64)
+        fp = self.matrix.sum(axis=0) - tp
+        fn = self.matrix.sum(axis=1) - tp
+        denominator = tp + fp + fn
+
+        iou = np.full(self.n_classes, np.nan)
+        present = (denominator > 0) & self.evaluated
+        iou[present] = tp[present] / denominator[present]
+        return iou
+
+    def mean_iou(self):
+        iou = self.per_class_iou()[self.evaluated]
+        iou = iou[~np.isnan(iou)]
+        return float(np.mean(iou)) if len(iou) > 0 else 0.
+
+    def pixel_accuracy(self):
+        total = self.matrix.sum()
+        return float(np.trace(self.matrix)) / total if total > 0 else 0.
+
+    def fps(self):
+        return self.frames / max(self.predict_time, 1e-6)
+
+    def summary(self):
+        print("-- IoU per class:")
+        for name, iou, evaluated in zip(self.class_names, self.per_class_iou(), self.evaluated):
+            if evaluated:
+                print("   %-20s %s" % (name, 'nan' if np.isnan(iou) else '%.4f' % iou))
+
+        print("-- mIoU %.4f, pixel accuracy %.4f, %d frames, %.2f fps" % (
+            self.mean_iou(), self.pixel_accuracy(), self.frames, self.fps()))
+
+
+def evaluate(model, sequence, confusion_matrix, output_index=0, verbose=True):
+    """
+    Predicts all batches of sequence and accumulates confusion matrix
+
+    :param keras.models.Model model:
+    :param keras.utils.Sequence sequence: batches (inputs, outputs) e.g. BaseDataGenerator.sequence('val', ...)
+    :param ConfusionMatrix confusion_matrix:
+    :param int output_index: which output (and ground truth) is evaluated for models with more outputs
+    :param bool verbose: prints progress
+    :rtype: ConfusionMatrix
+    """
+    steps = len(sequence)
+    for i in range(steps):
+        x, y = sequence[i]
+
+        start = time.time()
+        prediction = model.predict_on_batch(x)
+        confusion_matrix.predict_time += time.time() - start
+
+        if isinstance(prediction, list):
+            prediction = prediction[output_index]
+        if isinstance(y, list):
+            y = y[output_index]
+
+        confusion_matrix.update(y, prediction)
+        confusion_matrix.frames += len(prediction)
+
+        if verbose and ((i + 1) % 50 == 0 or i + 1 == steps):
+            print("-- evaluated %d/%d batches, mIoU %.4f" % (i + 1, steps, confusion_matrix.mean_iou()))
+
+    return confusion_matrix
+
+
+if __name__ == '__main__':
+    # sanity check against direct per-class counting
+    n_classes = 5
+    cm = ConfusionMatrix(n_classes, ignored_classes=[0])
+    trues = []
+    preds = []
+    for _ in range(3):
+        y_true = np.random.randint(0, n_classes, (2, 16, 32, 1))
+        y_pred = np.random.rand(2, 16, 32, n_classes)
+        cm.update(y_true, y_pred)
+        trues.append(y_true[..., 0].ravel())
+        preds.append(np.argmax(y_pred, axis=-1).ravel())
+
+    true = np.concatenate(trues)
+    pred = np.concatenate(preds)
+    valid = true != 0
+    for c in range(1, n_classes):
+        intersection = np.sum((true == c) & (pred == c) & valid)
+        union = np.sum(((true == c) | (pred == c)) & valid)
+        assert abs(cm.per_class_iou()[c] - float(intersection) / union) < 1e-12
+
+    cm.summary()
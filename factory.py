@@ -0,0 +1,82 @@
+from generator import *
+from models import *
+
+# model names (as in train.py) -> model class
+MODELS = {
+    'segnet': SegNet,
+    'segnet_warp0': SegnetWarp0,
+    'segnet_warp1': SegnetWarp1,
+    'segnet_warp2': SegnetWarp2,
+    'segnet_warp3': SegnetWarp3,
+    'segnet_warp01': SegnetWarp01,
+    'segnet_warp12': SegnetWarp12,
+    'segnet_warp23': SegnetWarp23,
+    'segnet_warp012': SegnetWarp012,
+    'segnet_warp123': SegnetWarp123,
+    'segnet_warp0123': SegnetWarp0123,
+    'icnet': ICNet,
+    'icnet_warp0': ICNetWarp0,
+    'icnet_warp1': ICNetWarp1,
+    'icnet_warp2': ICNetWarp2,
+    'icnet_warp01': ICNetWarp01,
+    'icnet_warp12': ICNetWarp12,
+    'icnet_warp012': ICNetWarp012,
+}
+
+
+def create_generator(model_name, dataset_path, debug_samples=0, optical_flow_type='farn', sparse_labels=False, flow_cache=None):
+    """
+    Generator with data in format of the model
+
+    :param str model_name: one of MODELS
+    :param str dataset_path:
+    :param int debug_samples:
+    :param str optical_flow_type: farn | dis | deepflow
+    :param bool sparse_labels:
+    :param FlowCache flow_cache:
+    :rtype: BaseDataGenerator
+    """
+    is_debug = debug_samples > 0
+    prev_skip = 0
+
+    if model_name == 'segnet':
+        return CityscapesGenerator(dataset_path, debug_samples=debug_samples, sparse_labels=sparse_labels)
+    elif 'segnet_warp' in model_name:
+        return CityscapesFlowGenerator(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type, sparse_labels=sparse_labels, flow_cache=flow_cache)
+    elif model_name == 'icnet':
+        return CityscapesGeneratorForICNet(dataset_path, debug_samples=debug_samples, sparse_labels=sparse_labels)
+    elif 'icnet_warp' in model_name:
+        return CityscapesFlowGeneratorForICNet(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type, sparse_labels=sparse_labels, flow_cache=flow_cache)
+    else:
+        raise Exception("Unknown model!")
+
+
+def create_model(model_name, target_size, n_classes, debug_samples=0, sparse_labels=False, old_frame='shared', for_training=True,
+                 input_dtype='float32', warp_method='gather'):
+    """
+    :param str model_name: one of MODELS
+    :param tuple target_size: (height, width)
+    :param int n_classes:
+    :param int debug_samples:
+    :param bool sparse_labels:
+    :param str old_frame: previous frame in training of warp models (see ICNetWarp, SegNetWarp)
+    :param bool for_training:
+    :param str input_dtype: float32 | float16 (frames and flow, see BaseDataGenerator.set_input_dtype)
+    :param str warp_method: warping of warp models (see Warp.METHODS)
+    :rtype: BaseModel
+    """
+    if model_name not in MODELS:
+        raise Exception("Unknown model!")
+
+    model_class = MODELS[model_name]
+    kwargs = {
+        'debug_samples': debug_samples,
+        'for_training': for_training,
+        'sparse_labels': sparse_labels,
+        'input_dtype': input_dtype
+    }
+    if issubclass(model_class, (SegNetWarp, ICNetWarp)):
+        kwargs['old_frame'] = old_frame
+        kwargs['warp_method'] = warp_method
+
+    return model_class(target_size, n_classes, **kwargs)
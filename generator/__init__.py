@@ -5,4 +5,11 @@ from cityscapes_flow_generator import CityscapesFlowGenerator
 from gta_generator import GTAGenerator
 from cityscapes_generator_for_icnet import CityscapesGeneratorForICNet
 from cityscapes_flow_generator_for_icnet import CityscapesFlowGeneratorForICNet
-from base_generator import BaseFlowGenerator, BaseDataGenerator
\ No newline at end of file
+from base_generator import BaseFlowGenerator, BaseDataGenerator, BatchRing
+from flow_cache import FlowCache
+from packed_dataset import PackedDataset
+from feature_cache import FeatureCache
+from augmentation import Augmentation, AugmentParams
+from frame_cache import FrameCache
+from staging import Stager
+from sampler import EpochSampler
\ No newline at end of file
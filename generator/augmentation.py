@@ -0,0 +1,170 @@
+import math
+import random
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# parameters of augmentation sampled once per sample and applied to all its frames, labels and flow
+# gamma is an index into the bank of quantized gamma tables (0 for no brightness change)
+AugmentParams = namedtuple('AugmentParams', ['flip', 'angle', 'scale', 'gamma'])
+
+
+class Augmentation:
+    """
+    Training augmentation: horizontal flip, rotation, zoom (fused into one affine warp) and gamma brightness.
+    Parameters are sampled by `sample` and the same parameters are then applied to every frame of the sample,
+    so frames of a flow pair stay temporally consistent and labels and flow stay aligned with frames.
+    """
+
+    IDENTITY = AugmentParams(flip=False, angle=0.0, scale=1.0, gamma=0)
+
+    # gamma tables are quantized by this step of log(gamma) and cached
+    GAMMA_STEP = 0.01
+    _gamma_luts = {}
+
+    # warpAffine is limited to 512 channels
+    MAX_CHANNELS = 256
+
+    def __init__(self, flip=False, rotation=0.0, zoom=0.0, brightness=0.0):
+        """
+        :param bool flip: random horizontal flip
+        :param float rotation: sigma of rotation in degrees (0 to disable)
+        :param float zoom: sigma of scale (0 to disable)
+        :param float brightness: sigma of gamma (0 to disable)
+        """
+        self.flip = flip
+        self.rotation = rotation
+        self.zoom = zoom
+        self.brightness = brightness
+
+    def sample(self, rng=random):
+        """
+        :param rng: random generator (random.Random or random module)
+        :rtype: AugmentParams
+        """
+        flip = bool(self.flip and rng.randint(0, 1))
+        angle = rng.gauss(mu=0.0, sigma=self.rotation) if self.rotation else 0.0
+        scale = rng.gauss(mu=1.0, sigma=self.zoom) if self.zoom else 1.0
+
+        gamma = 0
+        if self.brightness:
+            factor = 1.0 + abs(rng.gauss(mu=0.0, sigma=self.brightness))
+            if rng.randint(0, 1):
+                factor = 1.0 / factor
+            gamma = int(round(math.log(factor) / self.GAMMA_STEP))
+
+        return AugmentParams(flip=flip, angle=angle, scale=scale, gamma=gamma)
+
+    @classmethod
+    def gamma_lut(cls, gamma):
+        """
+        :param int gamma: quantized gamma index
+        :return: uint8 lookup table (256,)
+        """
+        lut = cls._gamma_luts.get(gamma)
+        if lut is None:
+            factor = math.exp(gamma * cls.GAMMA_STEP)
+            lut = ((np.arange(256) / 255.0) ** factor * 255).astype(np.uint8)
+            cls._gamma_luts[gamma] = lut
+        return lut
+
+    @staticmethod
+    def matrix(params, size):
+        """
+        Affine matrix of flip followed by rotation and zoom around the center
+        :param AugmentParams params:
+        :param tuple size: (height, width)
+        :return: (2, 3) float64
+        """
+        height, width = size[:2]
+        m = cv2.getRotationMatrix2D(((width - 1) / 2.0, (height - 1) / 2.0), params.angle, params.scale)
+        if params.flip:
+            # x -> width - 1 - x, same as cv2.flip
+            m = m.dot(np.array([[-1.0, 0.0, width - 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]))
+        return m
+
+    @staticmethod
+    def is_affine(params):
+        return params.angle != 0.0 or params.scale != 1.0
+
+    def _warp(self, arr, params, interpolation):
+        """
+        :param arr: (height, width[, channels])
+        :param AugmentParams params:
+        :param int interpolation: cv2 interpolation flag
+        :return: arr transformed by flip, rotation and zoom (borders are zero)
+        """
+        if not self.is_affine(params):
+            return cv2.flip(arr, 1) if params.flip else arr
+
+        m = self.matrix(params, arr.shape)
+        dsize = (arr.shape[1], arr.shape[0])
+        if arr.ndim == 2 or 1 < arr.shape[2] <= self.MAX_CHANNELS:
+            return cv2.warpAffine(arr, m, dsize, flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        # single channel is squeezed and too many channels are not supported by warpAffine
+        return np.concatenate([
+            cv2.warpAffine(arr[..., i:i + self.MAX_CHANNELS], m, dsize, flags=interpolation,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0).reshape(arr.shape[:2] + (-1,))
+            for i in range(0, arr.shape[2], self.MAX_CHANNELS)
+        ], axis=-1)
+
+    def apply_image(self, img, params):
+        """
+        :param img: uint8 frame (height, width, 3)
+        :param AugmentParams params:
+        """
+        if params.gamma:
+            img = cv2.LUT(img, self.gamma_lut(params.gamma))
+        return self._warp(img, params, cv2.INTER_LINEAR)
+
+    def apply_label(self, label, params):
+        """
+        :param label: label image (any resolution), areas outside of the frame become 0 (unlabeled)
+        :param AugmentParams params:
+        """
+        return self._warp(label, params, cv2.INTER_NEAREST)
+
+    def apply_features(self, features, params):
+        """
+        :param features: feature map of a frame (height, width, channels), e.g. float16 from feature cache
+        :param AugmentParams params:
+        """
+        if not self.is_affine(params):
+            return features[:, ::-1] if params.flip else features
+
+        # cv2 doesn't warp float16
+        return self._warp(features.astype(np.float32), params, cv2.INTER_LINEAR).astype(features.dtype)
+
+    def apply_flow(self, flow, params):
+        """
+        Transforms flow field consistently with frames: field is warped as image and vectors
+        are transformed by the linear part of the affine matrix (u is negated by flip).
+
+        :param flow: (height, width, 2) float32 displacement (x, y) in pixels
+        :param AugmentParams params:
+        """
+        if not params.flip and not self.is_affine(params):
+            return flow
+
+        a = self.matrix(params, flow.shape)[:, :2]
+        warped = self._warp(flow, params, cv2.INTER_LINEAR)
+        return warped.dot(a.T).astype(np.float32)
+
+
+if __name__ == '__main__':
+    # consistency check: flow of transformed frames equals transformed flow
+    augmentation = Augmentation(flip=True, rotation=5.0, zoom=0.1, brightness=0.1)
+    size = (64, 128)
+    ys, xs = np.mgrid[0:size[0], 0:size[1]].astype(np.float32)
+    shift = np.array([3.0, -2.0], dtype=np.float32)
+    flow = np.zeros(size + (2,), dtype=np.float32) + shift
+
+    for params in [AugmentParams(True, 0.0, 1.0, 0), AugmentParams(True, 7.0, 1.2, 3), augmentation.sample()]:
+        m = augmentation.matrix(params, size)
+        out = augmentation.apply_flow(flow, params)
+        # transformed point of x + flow(x) minus transformed point of x
+        expected = m[:, :2].dot(shift)
+        inner = out[16:-16, 32:-32]
+        print("-- %s max error %g" % (params, np.max(np.abs(inner - expected))))
@@ -1,15 +1,14 @@
 import datetime
-import itertools
-import time
 from abc import ABCMeta, abstractmethod, abstractproperty
 from math import ceil
 
 import cv2
 import os
 import random
-import tensorflow as tf
 from keras.preprocessing.image import *
-import shutil
+from keras.utils import Sequence
+
+from augmentation import Augmentation
 
 
 class threadsafe_iter:
@@ -24,9 +23,11 @@ class threadsafe_iter:
     def __iter__(self):
         return self
 
-    def next(self):
+    def __next__(self):
         with self.lock:
-            return self.it.next()
+            return next(self.it)
+
+    next = __next__
 
 
 def threadsafe_generator(f):
@@ -39,16 +40,208 @@ def threadsafe_generator(f):
     return g
 
 
+class BatchRing:
+    """
+    Ring of preallocated batch buffers reused by consecutive batches, samples are written into them in place.
+    Returned batch is valid until `size` more batches are built, so size has to be greater than number of batches
+    alive at once (see enqueuer_size).
+
+    The bound holds only for a single consumer: ring must be read by one enqueuer and nothing else,
+    any other batches built from it (e.g. evaluation pass over the same sequence) overwrite queued batches.
+    """
+
+    # batch being consumed and batch being built besides the queue and batches of workers
+    MARGIN = 2
+
+    def __init__(self, size):
+        """
+        :param int size: number of buffers in ring
+        """
+        self.size = size
+        self._slots = [None] * size
+        self._next = 0
+        self._lock = threading.Lock()
+        self._attached = False
+
+    @classmethod
+    def enqueuer_size(cls, max_queue_size, workers):
+        """
+        :return int: smallest ring for keras enqueuer with given queue and workers
+        """
+        return max_queue_size + workers + cls.MARGIN
+
+    def attach(self, max_queue_size, workers):
+        """
+        Registers the only consumer of the ring (keras enqueuer)
+        :param int max_queue_size:
+        :param int workers:
+        """
+        assert not self._attached, "Ring of batch buffers is already read by another enqueuer"
+        assert self.size >= self.enqueuer_size(max_queue_size, workers), \
+            "Ring of %d batch buffers is smaller than %d batches alive in enqueuer (queue %d, workers %d)" % (
+                self.size, self.enqueuer_size(max_queue_size, workers), max_queue_size, workers)
+        self._attached = True
+
+    def _acquire(self):
+        with self._lock:
+            slot = self._next
+            self._next = (self._next + 1) % self.size
+        return slot
+
+    @staticmethod
+    def _fits(buffers, arrays, batch_size):
+        if buffers is None or len(buffers) != len(arrays):
+            return False
+
+        for buffer, arr in zip(buffers, arrays):
+            if buffer.shape[0] < batch_size or buffer.shape[1:] != arr.shape or buffer.dtype != arr.dtype:
+                return False
+        return True
+
+    def collate(self, samples, batch_size):
+        """
+        Writes samples into next buffer of the ring as they come
+        :param samples: iterable of (inputs, outputs) from _get_sample
+        :param int batch_size: maximal number of samples
+        :return tuple: (list of input batches, list of output batches), views into the buffer
+        """
+        slot = self._acquire()
+        buffers = self._slots[slot]
+        n_inputs = None
+        n = 0
+
+        for i, (inputs, outputs) in enumerate(samples):
+            arrays = [np.asarray(arr) for arr in list(inputs) + list(outputs)]
+            if i == 0:
+                n_inputs = len(inputs)
+                if not self._fits(buffers, arrays, batch_size):
+                    buffers = [np.empty((batch_size,) + arr.shape, dtype=arr.dtype) for arr in arrays]
+                    self._slots[slot] = buffers
+
+            for buffer, arr in zip(buffers, arrays):
+                buffer[i] = arr
+            n = i + 1
+
+        batch = [buffer[:n] for buffer in buffers]
+        return batch[:n_inputs], batch[n_inputs:]
+
+
+class DataSequence(Sequence):
+    """
+    Indexed dataset of batches (keras.utils.Sequence).
+    Every batch is built independently with its own random generator seeded by (seed, epoch, index),
+    so batches may be built in parallel (threads or processes) with deterministic augmentation.
+    Order of samples of every epoch is given by EpochSampler (block-shuffled for locality).
+    """
+
+    def __init__(self, datagen, type, batch_size, target_size, shuffle=True, seed=0, buffers=0, block_size=64,
+                 partial=False):
+        """
+        :param BaseDataGenerator datagen: generator with loaded files
+        :param str type: train | val | test
+        :param int batch_size:
+        :param tuple target_size: (height, width)
+        :param bool shuffle: shuffles samples after every epoch
+        :param int seed:
+        :param int buffers: size of ring of reused batch buffers (see BatchRing), 0 for new arrays for every batch
+        :param int block_size: samples shuffled together (see EpochSampler), 1 for full shuffle
+        :param bool partial: every sample exactly once, last batch is smaller (e.g. for evaluation),
+            otherwise only full batches (see steps_per_epoch)
+        """
+        if not datagen._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
+
+        self.datagen = datagen
+        self.type = type
+        self.batch_size = batch_size
+        self.target_size = target_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.partial = partial
+        self.epoch = 0
+        self.ring = BatchRing(buffers) if buffers > 0 else None
+        self.sampler = datagen.sampler(type, shuffle=shuffle, seed=seed, block_size=block_size)
+        self._order = None
+        self._epoch_order()
+
+    def _epoch_order(self):
+        self._order = self.sampler.order(self.epoch)
+
+        # files of the epoch are staged in order of batches (keras must not shuffle batches)
+        if self.datagen.stager is not None:
+            data = self.datagen._data[self.type]
+            self.datagen.stager.schedule(self.type, [self.datagen.sample_paths(data[i]) for i in self._order],
+                                         self.epoch)
+
+    def attach_enqueuer(self, max_queue_size, workers):
+        """
+        Checks that the sequence with reused buffers is read by one enqueuer only (see BatchRing)
+        :param int max_queue_size:
+        :param int workers:
+        """
+        if self.ring is not None:
+            self.ring.attach(max_queue_size, workers)
+
+    def __len__(self):
+        if self.partial:
+            return int(ceil(len(self._order) / float(self.batch_size)))
+        return self.datagen.steps_per_epoch(self.type, self.batch_size)
+
+    def __getitem__(self, idx):
+        rng = random.Random((self.seed * 100003 + self.epoch) * 1000003 + idx)
+        data = self.datagen._data[self.type]
+
+        end = (idx + 1) * self.batch_size
+        if self.partial:
+            end = min(end, len(self._order))
+
+        samples = (
+            self.datagen._get_sample(self.type, data[self._order[i % len(self._order)]], self.target_size, rng)
+            for i in range(idx * self.batch_size, end)
+        )
+
+        if self.ring is not None:
+            return self.ring.collate(samples, self.batch_size)
+        return self.datagen._collate(list(samples))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._epoch_order()
+
+
 class BaseDataGenerator:
     __metaclass__ = ABCMeta
 
     _files_loaded = False
+    _label_imread_flags = cv2.IMREAD_COLOR
+    packed = None
+    frame_cache = None
+    stager = None
+
+    # minmax - every frame scaled by its own min and max (as original models were trained)
+    # fixed - frames scaled by 1/255, independent of frame content
+    NORMALIZATIONS = ['minmax', 'fixed']
+    normalization = 'minmax'
+    # type of frames (and flow) fed to models, see set_input_dtype
+    input_dtype = np.float32
+    _fixed_lut = None
+    # labels at target size for every model (see use_full_labels)
+    full_labels = False
 
     @abstractproperty
     def name(self):
         pass
 
-    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1):
+    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1, sparse_labels=False):
+        """
+        :param str dataset_path:
+        :param int debug_samples:
+        :param bool flip_enabled:
+        :param float rotation:
+        :param float zoom:
+        :param float brightness:
+        :param bool sparse_labels: yields class index maps (height, width, 1) instead of one-hot tensors
+        """
         self._debug_samples = debug_samples
         self.is_augment = debug_samples > 50 or debug_samples == 0
         self._data = {'train': [], 'val': [], 'test': []}
@@ -57,9 +250,12 @@ class BaseDataGenerator:
         self.zoom = zoom
         self.rotation = rotation
         self.brightness = brightness
+        self.sparse_labels = sparse_labels
+        self.augmentation = Augmentation(flip_enabled, rotation, zoom, brightness)
 
         print("--- flip " + str(self.flip_enabled))
         print("--- augmentation " + str(self.is_augment))
+        print("--- sparse labels " + str(self.sparse_labels))
         print(dataset_path)
 
     def load_files(self):
@@ -78,6 +274,58 @@ class BaseDataGenerator:
 
         self._files_loaded = True
 
+    def load_packed(self, packed_path):
+        """
+        Uses packed dataset (pre-resized frames and labels) instead of decoding image files
+        Files which are not packed (or flow with different target size) are still loaded from dataset.
+
+        :param str packed_path: directory with packed dataset (see pack_dataset.py)
+        """
+        from packed_dataset import PackedDataset
+        self.packed = PackedDataset(packed_path)
+
+    def use_frame_cache(self, max_size):
+        """
+        Keeps decoded frames resized to target size in memory (LRU), see FrameCache
+        :param int max_size: size limit in bytes
+        """
+        from frame_cache import FrameCache
+        self.frame_cache = FrameCache(max_size)
+
+    def use_staging(self, scratch_dir, capacity=None, workers=4, read_ahead=512):
+        """
+        Copies files of upcoming samples to local scratch in background (see Stager),
+        order of files is published by sequences (see DataSequence)
+
+        :param str scratch_dir: local directory (may be shared, files are staged into own subdirectory)
+        :param int capacity: size limit in bytes (None for unlimited)
+        :param int workers: number of copying threads
+        :param int read_ahead: number of samples staged ahead
+        """
+        from staging import Stager
+        self.stager = Stager(self.dataset_path, scratch_dir, capacity, workers, read_ahead)
+
+    def use_full_labels(self):
+        """
+        Yields only labels at target size (encode_labels), instead of labels of all outputs of graph for training
+        (e.g. label pyramid of ICNet), for evaluation of models built for inference
+        """
+        self.full_labels = True
+
+    @staticmethod
+    def sample_paths(item):
+        """
+        :param tuple item: sample from loaded split (frame path or paths, label path)
+        :return list: all file paths of the sample
+        """
+        img_paths, label_path = item
+        if isinstance(img_paths, str):
+            img_paths = [img_paths]
+        return list(img_paths) + [label_path]
+
+    def _packed_key(self, path):
+        return os.path.relpath(path, self.dataset_path)
+
     @abstractproperty
     def config(self):
         return {'labels': None, 'n_classes': None}
@@ -94,6 +342,22 @@ class BaseDataGenerator:
         """
         return self.config['labels']
 
+    @property
+    def ignored_classes(self):
+        """
+        :rtype list:
+        :return: class indexes ignored in evaluation
+        """
+        return []
+
+    @property
+    def class_names(self):
+        """
+        :rtype list:
+        :return: names of classes (None if dataset doesn't have them)
+        """
+        return None
+
     @abstractmethod
     def _fill_split(self, which_set):
         """
@@ -102,47 +366,103 @@ class BaseDataGenerator:
         """
         pass
 
-    def shuffle(self, type):
-        print("Cityscapes: shuffling dataset")
-        random.shuffle(self._data[type])
+    def _get_sample(self, type, item, target_size, rng=random):
+        """
+        Prepares one sample
+
+        :param str type: one of [train,val,test]
+        :param tuple item: (img_path, label_path) from loaded split
+        :param tuple target_size: (height, width)
+        :param rng: random generator used for augmentation (random.Random or random module)
+        :return tuple: (list of inputs, list of outputs)
+        """
+        img_path, label_path = item
+
+        params = self._augment_params(type, rng)
+
+        img = self._prep_img(img_path, target_size, params)
+        img = self.normalize(img, target_size)
+
+        seg_img = self._prep_gt(label_path, target_size, params)
+        seg_tensor = self.encode_labels(seg_img, target_size)
+
+        return [img], [seg_tensor]
+
+    @staticmethod
+    def _collate(samples):
+        """
+        Stacks samples into batch
+        :param list samples: list of (inputs, outputs) from _get_sample
+        :return tuple: (list of input batches, list of output batches)
+        """
+        inputs, outputs = zip(*samples)
+        x = [np.asarray(arr) for arr in zip(*inputs)]
+        y = [np.asarray(arr) for arr in zip(*outputs)]
+        return x, y
+
+    def sample_group(self, item):
+        """
+        Group of samples read together (see EpochSampler), directory of the label by default (e.g. city)
+        :param tuple item: sample from loaded split
+        :return str:
+        """
+        return os.path.dirname(item[1])
+
+    def sampler(self, type, shuffle=True, seed=0, block_size=64):
+        """
+        Order of samples of epochs, samples are grouped by sample_group and sorted by label path
+
+        :param type: one of [train,val,test]
+        :param bool shuffle:
+        :param int seed:
+        :param int block_size: samples shuffled together, 1 for full shuffle
+        :rtype: EpochSampler
+        """
+        from sampler import EpochSampler
+        keys = [(self.sample_group(item), item[1]) for item in self._data[type]]
+        return EpochSampler.from_keys(keys, block_size=block_size, shuffle=shuffle, seed=seed)
 
     @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
+    def flow(self, type, batch_size, target_size, buffers=0, shuffle=True, seed=0):
         """
         :param type: one of [train,val,test]
         :param batch_size:
         :param target_size:
+        :param int buffers: size of ring of reused batch buffers (see BatchRing), 0 for new arrays for every batch
+        :param bool shuffle: new order of samples every epoch (see sampler)
+        :param int seed:
         :return:
         """
         if not self._files_loaded:
             raise Exception('Files weren\'t loaded first!')
 
-        zipped = itertools.cycle(self._data[type])
-        i = 0
+        data = self._data[type]
+        stream = self.sampler(type, shuffle=shuffle, seed=seed).stream()
+        ring = BatchRing(buffers) if buffers > 0 else None
 
         while True:
-            X = []
-            Y = []
-
-            for _ in range(batch_size):
-                img_path, label_path = next(zipped)
-
-                apply_flip = random.randint(0, 1)
-
-                img = self._prep_img(type, img_path, target_size, apply_flip)
-                img = self.normalize(img, target_size)
-                X.append(img)
-
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-                seg_tensor = self.one_hot_encoding(seg_img, target_size)
-                Y.append(seg_tensor)
-
-            i += 1
+            samples = (self._get_sample(type, data[next(stream)[1]], target_size) for _ in range(batch_size))
+            if ring is not None:
+                yield ring.collate(samples, batch_size)
+            else:
+                yield self._collate(list(samples))
 
-            x = [np.asarray(X)]
-            y = [np.array(Y)]
+    def sequence(self, type, batch_size, target_size, shuffle=True, seed=0, buffers=0, block_size=64, partial=False):
+        """
+        Indexed dataset for parallel batch building (see DataSequence)
 
-            yield x, y
+        :param type: one of [train,val,test]
+        :param batch_size:
+        :param target_size:
+        :param bool shuffle:
+        :param int seed:
+        :param int buffers: size of ring of reused batch buffers (see BatchRing)
+        :param int block_size: samples shuffled together (see EpochSampler), 1 for full shuffle
+        :param bool partial: every sample exactly once with smaller last batch (for evaluation)
+        :rtype: DataSequence
+        """
+        return DataSequence(self, type, batch_size, target_size, shuffle=shuffle, seed=seed, buffers=buffers,
+                            block_size=block_size, partial=partial)
 
     def load_data(self, type, batch_size, target_size):
         """
@@ -189,95 +509,163 @@ class BaseDataGenerator:
         steps = max(1, int(self.data_length(type) // (batch_size * gpu_count)))
         return steps
 
-    def _load_img(self, img_path):
+    def _load_img(self, img_path, flags=cv2.IMREAD_COLOR):
         """
-        Loads image from path or fails with error
+        Loads image from path (staged copy when available) or fails with error
         :param img_path:
+        :param int flags: cv2.imread flags (e.g. cv2.IMREAD_GRAYSCALE for single channel labels)
         :return:
         """
-        old_path = img_path
-        img_path = self.copy_to_scratch(img_path)
-        # try scratch dir (if is found)
-        img = cv2.imread(img_path)
+        path = img_path if self.stager is None else self.stager.local_path(img_path)
+        img = cv2.imread(path, flags)
 
-        if img is None:
-            print("--- %s not found, trying again in a while" % img_path)
-            time.sleep(2)
-            img = cv2.imread(img_path)
-            print("--second attempt (%s) %s" % (img_path, str(img is None)))
-
-        # try old path
-        if img is None:
-            print("--- reading old path %s" % old_path)
-            img = cv2.imread(old_path)
-            print("--third attempt (%s) q%s" % (img_path, str(img is None)))
+        # staged copy may be evicted meanwhile
+        if img is None and path != img_path:
+            img = cv2.imread(img_path, flags)
 
         # raise if file not found
         if img is None:
             raise ValueError("Image %s was not found!" % img_path)
         return img
 
-    def copy_to_scratch(self, img_path):
-        if 'SCRATCH' in os.environ:
-            scratch_dir = os.environ['SCRATCH'] + '/'
-            file_name = os.path.split(img_path)[-1]
-            if not os.path.exists(scratch_dir + file_name):
-                print("-- copying %s to %s" % (os.environ['SCRATCH'] + '/', file_name))
-                shutil.copyfile(img_path, scratch_dir + file_name)
-            else:
-                img_path = scratch_dir + file_name
+    def _load_resized_img(self, img_path, target_size):
+        """
+        Loads image resized to target size (from packed dataset or frame cache when available)
+        :param str img_path:
+        :param tuple target_size: (height, width)
+        :return:
+        """
+        if self.packed is not None and self.packed.target_size == tuple(target_size):
+            img = self.packed.image(self._packed_key(img_path))
+            if img is not None:
+                return img
 
-        return img_path
+        if self.frame_cache is None:
+            return cv2.resize(self._load_img(img_path), target_size[::-1])
 
-    def _prep_img(self, type, img_path, target_size, apply_flip=False):
-        img = cv2.resize(self._load_img(img_path), target_size[::-1])
+        key = self.frame_cache.key(img_path, target_size)
+        img = self.frame_cache.get(key)
+        if img is None:
+            img = cv2.resize(self._load_img(img_path), target_size[::-1])
+            self.frame_cache.put(key, img)
+        return img
+
+    def _load_label(self, label_path, target_size):
+        """
+        Loads label image, resized to target size if taken from packed dataset (otherwise full size)
+        :param str label_path:
+        :param tuple target_size: (height, width)
+        :return:
+        """
+        if self.packed is not None and self.packed.target_size == tuple(target_size):
+            seg_img = self.packed.label(self._packed_key(label_path))
+            if seg_img is not None:
+                return seg_img
+
+        return self._load_img(label_path, self._label_imread_flags)
 
+    def _augment_params(self, type, rng=random):
+        """
+        Samples augmentation once per sample, the same parameters are applied to all its frames, labels and flow
+        :param str type: one of [train,val,test], only train samples are augmented
+        :param rng: random generator used for augmentation
+        :rtype: generator.augmentation.AugmentParams
+        """
         if self.is_augment and type == 'train':
-            if self.brightness:
-                factor = 1.0 + abs(random.gauss(mu=0.0, sigma=self.brightness))
-                if random.randint(0, 1):
-                    factor = 1.0 / factor
-                table = np.array([((i / 255.0) ** factor) * 255 for i in np.arange(0, 256)]).astype(np.uint8)
-                img = cv2.LUT(img, table)
-
-            if self.flip_enabled and apply_flip:
-                img = cv2.flip(img, 1)
-
-        # if self.rotation:
-        #     angle = random.gauss(mu=0.0, sigma=self.rotation)
-        # else:
-        #     angle = 0.0
-        # if self.zoom:
-        #     scale = random.gauss(mu=1.0, sigma=self.zoom)
-        # else:
-        #     scale = 1.0
-        #
-        # if self.rotation or self.zoom:
-        #     M = cv2.getRotationMatrix2D((img.shape[1] // 2, img.shape[0] // 2), angle, scale)
-        #     img = cv2.warpAffine(img, M, (img.shape[1], img.shape[0]))
+            return self.augmentation.sample(rng)
+        return Augmentation.IDENTITY
 
-        return img
+    def _prep_img(self, img_path, target_size, params=Augmentation.IDENTITY):
+        img = self._load_resized_img(img_path, target_size)
+        return self.augmentation.apply_image(img, params)
 
-    def normalize(self, rgb, target_size):
-        if target_size is not None:
-            rgb = cv2.resize(rgb, target_size[::-1])
+    def set_augmentation(self, rotation=5.0, zoom=0.1):
+        """
+        Sigmas of random rotation and zoom of train samples, 0 disables them (runs trained with flip and brightness only)
+        :param float rotation: sigma of rotation in degrees
+        :param float zoom: sigma of scale
+        """
+        self.rotation = rotation
+        self.zoom = zoom
+        self.augmentation = Augmentation(self.flip_enabled, rotation, zoom, self.brightness)
+        print("--- rotation %s, zoom %s" % (rotation, zoom))
 
-        norm_image = np.zeros_like(rgb, dtype=np.float32)
-        cv2.normalize(rgb, norm_image, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-        return norm_image
+    def set_normalization(self, normalization='minmax'):
+        """
+        :param str normalization: one of NORMALIZATIONS
+        """
+        if normalization not in self.NORMALIZATIONS:
+            raise ValueError("Unknown normalization %s, use one of %s" % (normalization, self.NORMALIZATIONS))
 
-    def _prep_gt(self, type, label_path, target_size, apply_flip=False):
-        seg_img = self._load_img(label_path)
+        self.normalization = normalization
+        self._fixed_lut = None
+        print("--- normalization %s" % normalization)
 
-        if self.is_augment and type == 'train':
-            if self.flip_enabled and apply_flip:
-                seg_img = cv2.flip(seg_img, 1)
+    def set_input_dtype(self, dtype='float32'):
+        """
+        float16 halves memory of queued batches and bytes moved to the device (model must have the same input_dtype)
+        :param str dtype: float32 | float16, type of normalized frames and flow
+        """
+        self.input_dtype = np.dtype(dtype).type
+        print("--- input dtype %s" % np.dtype(dtype).name)
+
+    def _mean_std(self):
+        """
+        :return: per-channel (mean, std) subtracted from frames scaled to [0, 1], None for no standardization
+        """
+        return None
+
+    def _normalization_lut(self, rgb):
+        """
+        Lookup table mapping uint8 values to normalized values, scaling and standardization folded together
+        :param rgb: uint8 frame (height, width, channels)
+        :return: float32 (256, 1, channels)
+        """
+        if self.normalization == 'fixed' and self._fixed_lut is not None:
+            return self._fixed_lut
+
+        values = np.arange(256, dtype=np.float64)
+        if self.normalization == 'minmax':
+            # same as cv2.normalize(NORM_MINMAX), constant frame maps to 0
+            low, high = float(rgb.min()), float(rgb.max())
+            scale = 1.0 / (high - low) if high > low else 0.0
+            values = (values - low) * scale
+        else:
+            values /= 255.0
+
+        channels = rgb.shape[2] if rgb.ndim == 3 else 1
+        lut = np.repeat(values[:, np.newaxis], channels, axis=1)
+
+        mean_std = self._mean_std()
+        if mean_std is not None:
+            mean, std = mean_std
+            lut = (lut - np.asarray(mean)) / np.asarray(std)
+
+        lut = np.ascontiguousarray(lut, dtype=np.float32).reshape(256, 1, channels)
+        if self.normalization == 'fixed':
+            self._fixed_lut = lut
+        return lut
+
+    def normalize(self, rgb, target_size):
+        """
+        Fused preprocessing of uint8 frame: resize (only when size differs) and a single table lookup
+        doing scaling and standardization at once, without float temporaries.
 
-        # if self.rotation or self.zoom:
-        #     M = cv2.getRotationMatrix2D((seg_img.shape[1] // 2, seg_img.shape[0] // 2), angle, scale)
-        #     seg_img = cv2.warpAffine(seg_img, M, (seg_img.shape[1], seg_img.shape[0]))
+        :param rgb: uint8 frame (height, width, channels)
+        :param tuple target_size: (height, width), None to keep size
+        :return: normalized frame of input_dtype
+        """
+        if target_size is not None and rgb.shape[:2] != tuple(target_size):
+            rgb = cv2.resize(rgb, target_size[::-1])
+
+        norm_image = cv2.LUT(rgb, self._normalization_lut(rgb))
+        if self.input_dtype != np.float32:
+            norm_image = norm_image.astype(self.input_dtype)
+        return norm_image
 
-        return seg_img
+    def _prep_gt(self, label_path, target_size, params=Augmentation.IDENTITY):
+        seg_img = self._load_label(label_path, target_size)
+        return self.augmentation.apply_label(seg_img, params)
 
     def one_hot_encoding(self, label_img, target_size):
         label_img = cv2.cvtColor(label_img, cv2.COLOR_BGR2RGB)
@@ -294,32 +682,158 @@ class BaseDataGenerator:
 
         return seg_labels
 
+    _color_keys = None
+
+    def class_encoding(self, label_img, target_size):
+        """
+        Sparse encoding - class index for every pixel (colors without label are class 0)
+        :param label_img: BGR label image
+        :param tuple target_size: (height, width)
+        :return: uint8 array (height, width)
+        """
+        label_img = cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
+
+        if self._color_keys is None:
+            # sorted RGB colors packed to int, first label wins for duplicated colors
+            packed_labels = [(r << 16) | (g << 8) | b for r, g, b in self.labels]
+            keys, classes = np.unique(np.array(packed_labels, dtype=np.int32), return_index=True)
+            self._color_keys = keys, classes.astype(np.uint8)
+
+        keys, classes = self._color_keys
+        packed = (label_img[:, :, 2].astype(np.int32) << 16) | (label_img[:, :, 1].astype(np.int32) << 8) | label_img[:, :, 0]
+        pos = np.minimum(np.searchsorted(keys, packed), len(keys) - 1)
+        return np.where(keys[pos] == packed, classes[pos], 0).astype(np.uint8)
+
+    def encode_labels(self, label_img, target_size):
+        """
+        Encodes label image as training target (one-hot or sparse based on `sparse_labels`)
+        :param label_img:
+        :param tuple target_size: (height, width)
+        :return: uint8 array (height, width, n_classes) or (height, width, 1)
+        """
+        if self.sparse_labels:
+            return self.class_encoding(label_img, target_size)[:, :, np.newaxis]
+
+        return self.one_hot_encoding(label_img, target_size)
+
     @staticmethod
-    def get_color_from_label(class_id_image, n_classes, labels):
-        colored_image = np.zeros((class_id_image.shape[0], class_id_image.shape[1], 3), np.uint8)
-        for i in range(0, n_classes):
-            colored_image[class_id_image[:, :] == i] = labels[i]
-        return colored_image
+    def label_pyramid(label_img, target_size, subs):
+        """
+        Label image resized to `target_size // sub` for every subsampling factor, only the first level
+        is resized from full resolution and every next one from the previous level (nearest neighbour)
+
+        :param label_img:
+        :param tuple target_size: (height, width)
+        :param list subs: increasing subsampling factors, e.g. [4, 8, 16]
+        :return list: label images of all levels
+        """
+        levels = []
+        for sub in subs:
+            size = tuple(a // sub for a in target_size)
+            src = levels[-1] if levels else label_img
+            levels.append(cv2.resize(src, size[::-1], interpolation=cv2.INTER_NEAREST))
+        return levels
+
+    def encode_label_pyramid(self, label_img, target_size, subs):
+        """
+        Encodes label image as training targets of more resolutions (e.g. ICNet cascade outputs)
+        :param label_img:
+        :param tuple target_size: (height, width)
+        :param list subs: increasing subsampling factors, e.g. [4, 8, 16]
+        :return list: encoded labels (see encode_labels) of size `target_size // sub`
+        """
+        return [self.encode_labels(level, level.shape[:2]) for level in self.label_pyramid(label_img, target_size, subs)]
+
+    # palettes of class colors (see palette)
+    _palettes = {}
 
     @staticmethod
-    def one_hot_to_bgr(label, target_size, n_classes, labels, cvt_color=True):
+    def palette(n_classes, labels, bgr=False):
+        """
+        Lookup table of class colors, unknown class indexes are black
+        :param int n_classes:
+        :param list labels: RGB colors of classes
+        :param bool bgr: colors in BGR order (for cv2)
+        :return: (257, 3) uint8, last entry is black for indexes out of range
+        """
+        key = (n_classes, tuple(tuple(color) for color in labels[:n_classes]), bgr)
+        if key not in BaseDataGenerator._palettes:
+            lut = np.zeros((257, 3), dtype=np.uint8)
+            lut[:n_classes] = np.array(labels[:n_classes], dtype=np.uint8).reshape(-1, 3)
+            if bgr:
+                lut = np.ascontiguousarray(lut[:, ::-1])
+            BaseDataGenerator._palettes[key] = lut
+        return BaseDataGenerator._palettes[key]
+
+    @staticmethod
+    def get_color_from_label(class_id_image, n_classes, labels, bgr=False):
+        """
+        :param class_id_image: (height, width) class indexes
+        :param int n_classes:
+        :param list labels: RGB colors of classes
+        :param bool bgr: colors in BGR order
+        :return: (height, width, 3) uint8 colored image
+        """
+        lut = BaseDataGenerator.palette(n_classes, labels, bgr)
+        class_id_image = np.asarray(class_id_image)
+        if class_id_image.dtype == np.uint8:
+            return lut[class_id_image]
+
+        lut_index = class_id_image.astype(np.int32)
+        lut_index[(lut_index < 0) | (lut_index >= n_classes)] = len(lut) - 1
+        return lut[lut_index]
+
+    @staticmethod
+    def class_map(label, target_size, n_classes):
+        """
+        :param label: class scores or one-hot (any shape with height*width*n_classes values)
+        :param tuple target_size: (height, width)
+        :param int n_classes:
+        :return: (height, width) uint8 class indexes
+        """
+        if n_classes > 256:
+            raise ValueError("Class indexes of %d classes do not fit into uint8" % n_classes)
+
         class_scores = label.reshape(target_size + (n_classes,))
-        class_image = np.argmax(class_scores, axis=2)
-        colored_class_image = BaseDataGenerator.get_color_from_label(class_image, n_classes, labels)
-        if cvt_color:
-            colored_class_image = cv2.cvtColor(colored_class_image, cv2.COLOR_RGB2BGR)
-        return colored_class_image
+        return np.argmax(class_scores, axis=2).astype(np.uint8)
+
+    @staticmethod
+    def one_hot_to_bgr(label, target_size, n_classes, labels, cvt_color=True):
+        """
+        :param label: class scores / one-hot, or class indexes (height, width[, 1]) uint8
+        :param tuple target_size: (height, width)
+        :param int n_classes:
+        :param list labels: RGB colors of classes
+        :param bool cvt_color: BGR output (else RGB)
+        :return: (height, width, 3) uint8 colored image
+        """
+        if label.dtype == np.uint8 and label.size == target_size[0] * target_size[1]:
+            class_image = label.reshape(target_size)
+        else:
+            class_image = BaseDataGenerator.class_map(label, target_size, n_classes)
+
+        return BaseDataGenerator.get_color_from_label(class_image, n_classes, labels, bgr=cvt_color)
 
 
 class BaseFlowGenerator(BaseDataGenerator):
     __metaclass__ = ABCMeta
     optical_flow = None
+    flow_cache = None
+    features = None
+    feature_names = None
 
-    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1, optical_flow_type='farn'):
+    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1, sparse_labels=False, optical_flow_type='farn', flow_cache=None):
+        """
+        :param FlowCache flow_cache: on-disk cache of optical flow (None to always calculate flow)
+        """
         if not hasattr(self, 'optical_flow_type'):
             self.optical_flow_type = optical_flow_type
 
+        if self.flow_cache is None:
+            self.flow_cache = flow_cache
+
         print("-- Optical flow type", self.optical_flow_type)
+        print("-- Optical flow cache", self.flow_cache is not None)
 
         if self.optical_flow_type == 'dis':
             print("-- creating optical flow DIS")
@@ -337,7 +851,8 @@ class BaseFlowGenerator(BaseDataGenerator):
             flip_enabled=flip_enabled,
             rotation=rotation,
             zoom=zoom,
-            brightness=brightness
+            brightness=brightness,
+            sparse_labels=sparse_labels
         )
 
     def calc_optical_flow(self, old, new, with_time_difference=False):
@@ -359,40 +874,149 @@ class BaseFlowGenerator(BaseDataGenerator):
         else:
             return flow
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
+    def get_optical_flow(self, img_old_path, img_new_path, img_old, img_new, target_size):
+        """
+        Reverse optical flow (from new to old frame), taken from flow cache when available
+
+        :param str img_old_path:
+        :param str img_new_path:
+        :param img_old: old frame resized to target size (not augmented)
+        :param img_new: new frame resized to target size (not augmented)
+        :param tuple target_size: (height, width)
+        :return: flow (height, width, 2)
+        """
+        if self.flow_cache is None:
+            return self.calc_optical_flow(img_new, img_old)
+
+        key = self._flow_cache_key(img_old_path, img_new_path, target_size)
+        flow = self.flow_cache.get(key)
+        if flow is None:
+            flow = self.calc_optical_flow(img_new, img_old)
+            self.flow_cache.put(key, flow)
+
+        return flow
+
+    def _flow_cache_key(self, img_old_path, img_new_path, target_size):
+        return self.flow_cache.key(
+            os.path.relpath(img_old_path, self.dataset_path),
+            os.path.relpath(img_new_path, self.dataset_path),
+            self.optical_flow_type,
+            target_size
+        )
 
-        zipped = itertools.cycle(self._data[type])
+    def precompute_optical_flow(self, img_old_path, img_new_path, target_size):
+        """
+        Calculates optical flow of the pair into flow cache (skipped when already cached)
 
-        while True:
-            input1_arr = []
-            input2_arr = []
-            flow_arr = []
-            out_arr = []
+        :param str img_old_path:
+        :param str img_new_path:
+        :param tuple target_size: (height, width)
+        :return bool: True if flow was calculated, False if it was already cached
+        """
+        if self.flow_cache is None:
+            raise Exception('Flow cache is not set!')
 
-            for _ in range(batch_size):
-                (img_old_path, img_new_path), label_path = next(zipped)
+        if self._flow_cache_key(img_old_path, img_new_path, target_size) in self.flow_cache:
+            return False
 
-                img = cv2.resize(self._load_img(img_old_path), target_size[::-1])
-                img2 = cv2.resize(self._load_img(img_new_path), target_size[::-1])
-                flow = self.calc_optical_flow(img2, img)
+        img_old = self._load_resized_img(img_old_path, target_size)
+        img_new = self._load_resized_img(img_new_path, target_size)
+
+        self.get_optical_flow(img_old_path, img_new_path, img_old, img_new, target_size)
+        return True
+
+    def flow_pairs(self, type):
+        """
+        :param str type: train | val | test
+        :return list: (img_old_path, img_new_path) of all samples in the split
+        """
+        return [tuple(img_paths[-2:]) for img_paths, _ in self._data[type]]
 
-                input1 = self.normalize(img, target_size=None)
-                input2 = self.normalize(img2, target_size=None)
+    def load_features(self, features_path, names, target_size):
+        """
+        Yields cached features of previous frame after [img_old, img_new, flow] in inputs
+        (for warp models taking previous frame features as inputs in training).
+        Features must be computed from frames of the same size, normalization and input dtype.
 
-                input1_arr.append(input1)
-                input2_arr.append(input2)
-                flow_arr.append(flow)
+        :param str features_path: directory with feature cache (see precompute_features.py)
+        :param list names: feature names in order of model inputs
+        :param tuple target_size: (height, width) of frames
+        """
+        from feature_cache import FeatureCache
+        features = FeatureCache(features_path)
+
+        expected = {
+            'target size': tuple(target_size),
+            'normalization': self.normalization,
+            'input dtype': np.dtype(self.input_dtype).name
+        }
+        cached = {
+            'target size': features.target_size,
+            'normalization': features.normalization,
+            'input dtype': features.input_dtype
+        }
+        for what in sorted(expected):
+            if cached[what] != expected[what]:
+                raise ValueError("Features in %s were computed with %s %s, but %s is used" % (
+                    features_path, what, cached[what], expected[what]))
+
+        missing = [name for name in names if name not in features.names]
+        if missing:
+            raise ValueError("Features %s are not in %s" % (', '.join(missing), features_path))
+
+        self.features = features
+        self.feature_names = names
+
+    def _prev_features(self, img_old_path, params=Augmentation.IDENTITY):
+        """
+        :return list: cached features of previous frame (augmented with the frames), empty without feature cache
+        """
+        if self.features is None:
+            return []
 
-                seg_tensor = cv2.imread(label_path)
-                seg_tensor = self.one_hot_encoding(seg_tensor, target_size)
-                out_arr.append(seg_tensor)
+        features = self.features.get(self._packed_key(img_old_path), self.feature_names)
+        if features is None:
+            raise Exception("Features of %s are not cached" % img_old_path)
 
-            x = [np.asarray(input1_arr), np.asarray(input2_arr), np.asarray(flow_arr)]
-            y = np.array(out_arr)
-            yield x, y
+        return [self.augmentation.apply_features(feature, params) for feature in features]
+
+    def _prep_flow_pair(self, img_old_path, img_new_path, target_size, params=Augmentation.IDENTITY):
+        """
+        Loads pair of frames with reverse optical flow, both frames augmented by the same parameters.
+        Flow is calculated (or taken from the cache) once per pair on frames without augmentation,
+        flip, rotation and zoom are then applied to the flow field analytically.
+
+        :param str img_old_path:
+        :param str img_new_path:
+        :param tuple target_size: (height, width)
+        :param AugmentParams params: augmentation of the sample
+        :return tuple: (img_old, img_new, flow)
+        """
+        img_old = self._load_resized_img(img_old_path, target_size)
+        img_new = self._load_resized_img(img_new_path, target_size)
+
+        flow = self.get_optical_flow(img_old_path, img_new_path, img_old, img_new, target_size)
+
+        img_old = self.augmentation.apply_image(img_old, params)
+        img_new = self.augmentation.apply_image(img_new, params)
+        flow = self.augmentation.apply_flow(flow, params)
+
+        return img_old, img_new, flow.astype(self.input_dtype, copy=False)
+
+    def _get_sample(self, type, item, target_size, rng=random):
+        (img_old_path, img_new_path), label_path = item
+
+        img = self._load_resized_img(img_old_path, target_size)
+        img2 = self._load_resized_img(img_new_path, target_size)
+        flow = self.get_optical_flow(img_old_path, img_new_path, img, img2, target_size).astype(self.input_dtype, copy=False)
+
+        input1 = self.normalize(img, target_size=None)
+        input2 = self.normalize(img2, target_size=None)
+
+        seg_tensor = self._load_label(label_path, target_size)
+        seg_tensor = self.encode_labels(seg_tensor, target_size)
+
+        return [input1, input2, flow] + self._prev_features(img_old_path), [seg_tensor]
 
     @staticmethod
     def flow_to_bgr(flow, target_size):
@@ -406,17 +1030,14 @@ class BaseFlowGenerator(BaseDataGenerator):
 
     @staticmethod
     def calc_warp(img_old, flow, size):
+        """
+        Warps image by optical flow on CPU (same sampling as Warp layer)
+        :param img_old: (height, width, 3)
+        :param flow: (height, width, 2)
+        :param tuple size: (height, width) of img_old and flow
+        :return: warped image clipped to [0, 1]
+        """
         from models.layers.warp import Warp
 
-        with tf.Session() as sess:
-            a = tf.placeholder(tf.float32, shape=[None, None, None, 3])
-            flow_vec = tf.placeholder(tf.float32, shape=[None, None, None, 2])
-
-            init = tf.global_variables_initializer()
-            sess.run(init)
-            warp_graph = Warp.tf_warp(a, flow_vec, size)
-
-            out = sess.run(warp_graph, feed_dict={a: np.array([img_old]), flow_vec: np.array([flow])})
-            out = np.clip(out, 0, 1)
-            winner = out[0]
-            return winner
+        out = Warp.np_warp(img_old, flow)
+        return np.clip(out, 0, 1)
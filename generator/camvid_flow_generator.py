@@ -9,6 +9,14 @@ from camvid_generator import CamVidGenerator
 
 
 class CamVidFlowGenerator(CamVidGenerator, BaseFlowGenerator):
+    def __init__(self, dataset_path, debug_samples=0, optical_flow_type='farn', sparse_labels=False, flow_cache=None):
+        """
+        :param FlowCache flow_cache: on-disk optical flow cache
+        """
+        self.optical_flow_type = optical_flow_type
+        self.flow_cache = flow_cache
+        super(CamVidFlowGenerator, self).__init__(dataset_path, debug_samples, sparse_labels=sparse_labels)
+
     def _fill_split(self, which_set):
         img_path = os.path.join(self.dataset_path, '701_StillsRaw_full/', )
         lab_path = os.path.join(self.dataset_path, 'LabeledApproved_full/', )
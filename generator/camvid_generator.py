@@ -57,9 +57,9 @@ class CamVidGenerator(BaseDataGenerator):
             'n_classes': len(self._config['labels'])
         }
 
-    def __init__(self, dataset_path, debug_samples=0):
+    def __init__(self, dataset_path, debug_samples=0, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'camvid/')
-        super(CamVidGenerator, self).__init__(dataset_path, debug_samples)
+        super(CamVidGenerator, self).__init__(dataset_path, debug_samples, sparse_labels=sparse_labels)
 
     def _fill_split(self, which_set):
         img_path = os.path.join(self.dataset_path, '701_StillsRaw_full/', )
@@ -78,6 +78,12 @@ class CamVidGenerator(BaseDataGenerator):
         print('CamVid: ' + which_set + ' ' + str(len(filenames)) + ' files')
         self._data[which_set] = filenames
 
+    def sample_group(self, item):
+        """
+        :return str: sequence of the sample (prefix of file name, labels of all sequences are in one directory)
+        """
+        return os.path.basename(item[1]).split('_')[0]
+
     def _get_files(self, img_path, lab_path, prefix):
         img_files = glob.glob(img_path + prefix + "*.png")
         img_files.sort()
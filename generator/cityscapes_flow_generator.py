@@ -1,71 +1,42 @@
-import itertools
+import random
 
 import cv2
-import numpy as np
-import random
 
-from base_generator import BaseFlowGenerator, threadsafe_generator
+from base_generator import BaseFlowGenerator
 from cityscapes_generator import CityscapesGenerator
 
 
 class CityscapesFlowGenerator(CityscapesGenerator, BaseFlowGenerator):
-    def __init__(self, dataset_path, debug_samples=0, how_many_prev=1, prev_skip=0, flip_enabled=False, optical_flow_type='farn'):
+    def __init__(self, dataset_path, debug_samples=0, how_many_prev=1, prev_skip=0, flip_enabled=False, optical_flow_type='farn', sparse_labels=False, flow_cache=None):
+        """
+        :param FlowCache flow_cache: on-disk optical flow cache
+        """
         self.optical_flow_type = optical_flow_type
+        self.flow_cache = flow_cache
         super(CityscapesFlowGenerator, self).__init__(
             dataset_path=dataset_path,
             debug_samples=debug_samples,
             how_many_prev=how_many_prev,
             prev_skip=prev_skip,
-            flip_enabled=flip_enabled
+            flip_enabled=flip_enabled,
+            sparse_labels=sparse_labels
         )
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
-
-        zipped = itertools.cycle(self._data[type])
-        i = 0
-
-        while True:
-            Y = []
-
-            input1_arr = []
-            input2_arr = []
-            flow_arr = []
-
-            for _ in range(batch_size):
-                (img_old_path, img_new_path), label_path = next(zipped)
-
-                apply_flip = random.randint(0, 1)
-
-                img_old = self._prep_img(type, img_old_path, target_size, apply_flip)
-                img_new = self._prep_img(type, img_new_path, target_size, apply_flip)
-
-                # reverse flow
-                flow = self.calc_optical_flow(img_new, img_old)
-                flow_arr.append(flow)
-
-                input1 = self.normalize(img_old, target_size=None)
-                input1_arr.append(input1)
+    def _get_sample(self, type, item, target_size, rng=random):
+        (img_old_path, img_new_path), label_path = item
 
-                input2 = self.normalize(img_new, target_size=None)
-                input2_arr.append(input2)
+        params = self._augment_params(type, rng)
 
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-                seg_tensor = self.one_hot_encoding(seg_img, target_size)
-                Y.append(seg_tensor)
+        # reverse flow
+        img_old, img_new, flow = self._prep_flow_pair(img_old_path, img_new_path, target_size, params)
 
-            i += 1
+        input1 = self.normalize(img_old, target_size=None)
+        input2 = self.normalize(img_new, target_size=None)
 
-            x = [
-                np.asarray(input1_arr),
-                np.asarray(input2_arr),
-                np.asarray(flow_arr)
-            ]
+        seg_img = self._prep_gt(label_path, target_size, params)
+        seg_tensor = self.encode_labels(seg_img, target_size)
 
-            y = [np.array(Y)]
-            yield x, y
+        return [input1, input2, flow] + self._prev_features(img_old_path, params), [seg_tensor]
 
 
 if __name__ == '__main__':
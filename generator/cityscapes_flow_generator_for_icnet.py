@@ -1,84 +1,35 @@
-import itertools
-import os
 import random
 
 import cv2
-import numpy as np
 
-from base_generator import BaseFlowGenerator, threadsafe_generator
+from base_generator import BaseFlowGenerator
 from cityscapes_flow_generator import CityscapesFlowGenerator
 
-optflow_module = not ('WHICH_SERVER' in os.environ) or os.environ['WHICH_SERVER'] != 'metacentrum'
-
 
 class CityscapesFlowGeneratorForICNet(CityscapesFlowGenerator, BaseFlowGenerator):
     gt_sub = [4, 8, 16]
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
-
-        zipped = itertools.cycle(self._data[type])
-        i = 0
-
-        while True:
-            Y = []
-            Y2 = []
-            Y3 = []
-
-            input1_arr = []
-            input2_arr = []
-            flow_arr = []
-
-            for _ in range(batch_size):
-                (img_old_path, img_new_path), label_path = next(zipped)
-                apply_flip = self.flip_enabled and random.randint(0, 1)
-
-                img_old = self._prep_img(type, img_old_path, target_size, apply_flip)
-                img_new = self._prep_img(type, img_new_path, target_size, apply_flip)
-
-                # reverse flow
-                if optflow_module:
-                    # write optical flow to folder and read it from there
-                    flo_file = self.dataset_path + 'flow/' + os.path.split(img_old_path)[-1] + '.flo'
-                    if os.path.exists(flo_file):
-                        flow = cv2.optflow.readOpticalFlow(flo_file)
-                    else:
-                        flow = self.calc_optical_flow(img_new, img_old)
-                        cv2.optflow.writeOpticalFlow(flo_file, flow)
-                        print('writing optflow to %s' % flo_file)
-                else:
-                    flow = self.calc_optical_flow(img_new, img_old)
-
-                flow_arr.append(flow)
-
-                input1 = self.normalize(img_old, target_size=None)
-                input1_arr.append(input1)
-
-                input2 = self.normalize(img_new, target_size=None)
-                input2_arr.append(input2)
-
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
+    def _get_sample(self, type, item, target_size, rng=random):
+        (img_old_path, img_new_path), label_path = item
+        params = self._augment_params(type, rng)
 
-                seg_tensor = self.one_hot_encoding(seg_img, tuple(a // 4 for a in target_size))
-                Y.append(seg_tensor)
+        # reverse flow
+        img_old, img_new, flow = self._prep_flow_pair(img_old_path, img_new_path, target_size, params)
 
-                seg_tensor2 = self.one_hot_encoding(seg_img, tuple(a // 8 for a in target_size))
-                Y2.append(seg_tensor2)
+        input1 = self.normalize(img_old, target_size=None)
+        input2 = self.normalize(img_new, target_size=None)
 
-                seg_tensor3 = self.one_hot_encoding(seg_img, tuple(a // 16 for a in target_size))
-                Y3.append(seg_tensor3)
+        seg_img = self._prep_gt(label_path, target_size, params)
 
-            x = [
-                np.asarray(input1_arr),
-                np.asarray(input2_arr),
-                np.asarray(flow_arr)
-            ]
+        if self.full_labels:
+            # label of inference output (out_full)
+            seg_tensors = [self.encode_labels(seg_img, target_size)]
+        else:
+            # labels for outputs of all resolutions (1/4, 1/8, 1/16 of input)
+            seg_tensors = self.encode_label_pyramid(seg_img, target_size, self.gt_sub)
 
-            y = [np.array(Y), np.array(Y2), np.array(Y3)]
-            yield x, y
-            i += 1
+        inputs = [input1, input2, flow] + self._prev_features(img_old_path, params)
+        return inputs, seg_tensors
 
 
 if __name__ == '__main__':
@@ -8,8 +8,25 @@ from base_generator import BaseDataGenerator
 import numpy as np
 
 
+def _build_label_luts(labels):
+    """
+    Lookup tables from cityscapes labelId (0-255) to class index and to one-hot vector.
+    Ids without label (e.g. license plate has -1) stay as zero one-hot row and class 0.
+
+    :param list labels: cityscapes_labels.Label list (order defines class index)
+    :return tuple: (class lut (256,) uint8, one-hot lut (256, n_classes) uint8)
+    """
+    class_lut = np.zeros(256, dtype=np.uint8)
+    one_hot_lut = np.zeros((256, len(labels)), dtype=np.uint8)
+    for i, lab in enumerate(labels):
+        if 0 <= lab.id < 256:
+            class_lut[lab.id] = i
+            one_hot_lut[lab.id, i] = 1
+    return class_lut, one_hot_lut
+
+
 class CityscapesGenerator(BaseDataGenerator):
-    def __init__(self, dataset_path, debug_samples=0, how_many_prev=0, prev_skip=0, old_labels=False, flip_enabled=False):
+    def __init__(self, dataset_path, debug_samples=0, how_many_prev=0, prev_skip=0, old_labels=False, flip_enabled=False, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'cityscapes/')
         self._file_pattern = re.compile("(?P<city>[^_]*)_(?:[^_]+)_(?P<frame>[^_]+)_gtFine_labelIds\.png")
         self._how_many_prev = how_many_prev
@@ -18,11 +35,15 @@ class CityscapesGenerator(BaseDataGenerator):
         super(CityscapesGenerator, self).__init__(
             dataset_path,
             debug_samples,
-            flip_enabled=flip_enabled
+            flip_enabled=flip_enabled,
+            sparse_labels=sparse_labels
         )
 
     _city_labels = [lab.color for lab in cityscapes_labels.labels]
-    _city_labels_struct = [lab for lab in cityscapes_labels.labels]
+    _class_lut, _one_hot_lut = _build_label_luts(cityscapes_labels.labels)
+
+    # labelIds are stored as grayscale png (all channels are the same)
+    _label_imread_flags = cv2.IMREAD_GRAYSCALE
 
     _config = {
         'labels': _city_labels,
@@ -39,6 +60,14 @@ class CityscapesGenerator(BaseDataGenerator):
     def name(self):
         return 'city'
 
+    @property
+    def ignored_classes(self):
+        return [i for i, lab in enumerate(cityscapes_labels.labels) if lab.ignoreInEval]
+
+    @property
+    def class_names(self):
+        return [lab.name for lab in cityscapes_labels.labels]
+
     @property
     def config(self):
         return self._config
@@ -81,28 +110,58 @@ class CityscapesGenerator(BaseDataGenerator):
         print('Cityscapes: ' + which_set + ' ' + str(len(filenames)) + ' files')
         self._data[which_set] = filenames
 
-        if not self._debug_samples:
-            self.shuffle(which_set)
+    @staticmethod
+    def _label_ids(label_img, target_size):
+        """
+        :param label_img: labelIds image (single channel or 3 identical channels)
+        :param tuple target_size: (height, width)
+        :return: single channel labelIds image resized to target size
+        """
+        if label_img.ndim == 3:
+            label_img = np.ascontiguousarray(label_img[:, :, 0])
+        return cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
 
     def one_hot_encoding(self, label_img, target_size):
-        label_img = cv2.cvtColor(label_img, cv2.COLOR_BGR2RGB)
-        label_img = cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
-
-        label_list = []
-        for lab in self._city_labels_struct:
-            label_current = np.all(label_img == lab.id, axis=2).astype(np.uint8)
-            label_list.append(label_current)
-
-        label_arr = np.array(label_list)
-        seg_labels = np.rollaxis(label_arr, 0, 3)
-
-        return seg_labels
-
-    def normalize(self, rgb, target_size):
-        norm = super(CityscapesGenerator, self).normalize(rgb, target_size)
-        norm -= self._config['mean']
-        norm /= self._config['std']
-        return norm
+        """
+        Single pass one-hot encoding through lookup table
+        :param label_img: labelIds image
+        :param tuple target_size: (height, width)
+        :return: uint8 array (height, width, n_classes)
+        """
+        return self._one_hot_lut[self._label_ids(label_img, target_size)]
+
+    def class_encoding(self, label_img, target_size):
+        """
+        Sparse encoding - class index for every pixel
+        :param label_img: labelIds image
+        :param tuple target_size: (height, width)
+        :return: uint8 array (height, width)
+        """
+        return self._class_lut[self._label_ids(label_img, target_size)]
+
+    def encode_label_pyramid(self, label_img, target_size, subs):
+        """
+        All levels are encoded by a single lookup over concatenated labelIds
+        :param label_img: labelIds image
+        :param tuple target_size: (height, width)
+        :param list subs: increasing subsampling factors, e.g. [4, 8, 16]
+        :return list: uint8 arrays (height // sub, width // sub, n_classes or 1)
+        """
+        if label_img.ndim == 3:
+            label_img = np.ascontiguousarray(label_img[:, :, 0])
+
+        levels = self.label_pyramid(label_img, target_size, subs)
+        lut = self._class_lut[:, np.newaxis] if self.sparse_labels else self._one_hot_lut
+        encoded = lut[np.concatenate([level.ravel() for level in levels])]
+
+        ends = np.cumsum([level.size for level in levels])
+        return [
+            arr.reshape(level.shape + (-1,))
+            for arr, level in zip(np.split(encoded, ends[:-1]), levels)
+        ]
+
+    def _mean_std(self):
+        return self._config['mean'], self._config['std']
 
     def denormalize(self, rgb):
         rgb *= self._config['std']
@@ -1,62 +1,37 @@
-import itertools
 import random
 
 import cv2
-import numpy as np
 
 from cityscapes_generator import CityscapesGenerator
-from base_generator import threadsafe_generator
 
 
 class CityscapesGeneratorForICNet(CityscapesGenerator):
     gt_sub = [4, 8, 16]
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
+    def _get_sample(self, type, item, target_size, rng=random):
         """
         :param type: one of [train,val,test]
-        :param batch_size:
+        :param item: (img_path, label_path)
         :param target_size:
+        :param rng: random generator used for augmentation
         :return:
         """
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
+        img_path, label_path = item
+        params = self._augment_params(type, rng)
 
-        zipped = itertools.cycle(self._data[type])
-        i = 0
+        img = self._prep_img(img_path, target_size, params)
+        img = self.normalize(img, target_size)
 
-        while True:
-            X = [[]] * 1
+        seg_img = self._prep_gt(label_path, target_size, params)
 
-            Y = []
-            Y2 = []
-            Y3 = []
+        if self.full_labels:
+            # label of inference output (out_full)
+            seg_tensors = [self.encode_labels(seg_img, target_size)]
+        else:
+            # labels for outputs of all resolutions (1/4, 1/8, 1/16 of input)
+            seg_tensors = self.encode_label_pyramid(seg_img, target_size, self.gt_sub)
 
-            for _ in range(batch_size):
-                img_path, label_path = next(zipped)
-                apply_flip = self.flip_enabled and random.randint(0, 1)
-
-                img = self._prep_img(type, img_path, target_size, apply_flip)
-                img = self.normalize(img, target_size)
-
-                X[0].append(img)
-
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-
-                seg_tensor = self.one_hot_encoding(seg_img, tuple(a // 4 for a in target_size))  # target_size)
-                Y.append(seg_tensor)
-
-                seg_tensor2 = self.one_hot_encoding(seg_img, tuple(a // 8 for a in target_size))
-                Y2.append(seg_tensor2)
-
-                seg_tensor3 = self.one_hot_encoding(seg_img, tuple(a // 16 for a in target_size))
-                Y3.append(seg_tensor3)
-
-            i += 1
-
-            x = [np.asarray(j) for j in X]
-            y = [np.array(Y), np.array(Y2), np.array(Y3)]
-            yield x, y
+        return [img], seg_tensors
 
 
 if __name__ == '__main__':
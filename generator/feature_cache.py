@@ -0,0 +1,109 @@
+import json
+import os
+
+import numpy as np
+
+
+class FeatureCache:
+    """
+    Intermediate features of previous frames computed once by trained base model (e.g. ICNet for ICNetWarp),
+    packed into float16 memory-mapped arrays. Rows are read as views into the mapped files.
+
+    Directory layout:
+        index.json  - target size, normalization and dtype of input frames,
+                      keys (paths relative to dataset) of rows, feature names and shapes
+        <name>.npy  - (n_keys, height, width, channels) float16, one file per feature
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path):
+        """
+        Opens feature cache
+        :param str path: directory with feature cache
+        """
+        with open(os.path.join(path, self.INDEX_FILE), 'r') as fp:
+            index = json.load(fp)
+
+        self.path = path
+        self.target_size = tuple(index['target_size'])
+        self.normalization = index['normalization']
+        self.input_dtype = index['input_dtype']
+        self.names = list(index['names'])
+        self._rows = {key: i for i, key in enumerate(index['keys'])}
+        self._arrays = {
+            name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in self.names
+        }
+
+        print("-- Feature cache %s: %d frames of size %s (%s, %s), features %s" % (
+            path, len(self._rows), self.target_size, self.normalization, self.input_dtype, ', '.join(self.names)))
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def get(self, key, names):
+        """
+        :param str key: path relative to dataset
+        :param list names: feature names
+        :return: list of read-only views (height, width, channels) float16 or None if not cached
+        """
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        return [self._arrays[name][row] for name in names]
+
+    @classmethod
+    def pack(cls, path, target_size, keys, names, batches, normalization='minmax', input_dtype='float32'):
+        """
+        Writes feature cache. Index is written last, so unfinished cache can't be opened.
+
+        :param str path: output directory
+        :param tuple target_size: (height, width) of frames
+        :param list keys:
+        :param list names: feature names
+        :param batches: iterable of lists of feature batches (one array per name), rows in order of keys
+        :param str normalization: normalization of frames the features were computed from
+        :param str input_dtype: type of frames fed to the model
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        from utils import print_progress
+
+        arrays = None
+        i = 0
+        print_progress(0, len(keys), prefix='features', suffix='Complete', bar_length=50)
+        for features in batches:
+            if arrays is None:
+                arrays = [
+                    np.lib.format.open_memmap(
+                        os.path.join(path, name + '.npy'),
+                        mode='w+',
+                        dtype=np.float16,
+                        shape=(len(keys),) + feature.shape[1:]
+                    )
+                    for name, feature in zip(names, features)
+                ]
+
+            n = len(features[0])
+            for arr, feature in zip(arrays, features):
+                arr[i:i + n] = feature
+            i += n
+            print_progress(i, len(keys), prefix='features', suffix='Complete', bar_length=50)
+
+        shapes = []
+        for arr in arrays or []:
+            shapes.append(list(arr.shape[1:]))
+            arr.flush()
+        del arrays
+
+        with open(os.path.join(path, cls.INDEX_FILE), 'w') as fp:
+            json.dump({
+                'target_size': list(target_size),
+                'normalization': normalization,
+                'input_dtype': input_dtype,
+                'names': list(names),
+                'shapes': shapes,
+                'keys': list(keys)
+            }, fp)
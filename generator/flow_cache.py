@@ -0,0 +1,170 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+class FlowCache:
+    """
+    Persistent on-disk cache of optical flow fields shared by all flow generators (and workers).
+    Every flow is stored as single .npy file, key is made of frame pair, optical flow type and target size.
+    Writes are atomic (temporary file + rename) so more workers may fill the cache at once.
+    """
+
+    STORAGE_FORMATS = ['float32', 'float16', 'quantized']
+
+    # quantized format stores int16 with 1/64 px precision (range +-512 px)
+    QUANTIZATION_SCALE = 64.0
+
+    def __init__(self, cache_dir, storage='float16', max_size=None):
+        """
+        :param str cache_dir: directory of the cache (created if not exists)
+        :param str storage: one of [float32, float16, quantized]
+        :param int max_size: size limit of the cache in bytes (None for unlimited), oldest files are evicted
+        """
+        if storage not in self.STORAGE_FORMATS:
+            raise ValueError("Unknown flow cache storage %s, use one of %s" % (storage, self.STORAGE_FORMATS))
+
+        self.cache_dir = cache_dir
+        self.storage = storage
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another worker meanwhile
+                pass
+
+        print("-- Flow cache %s (storage %s, max size %s)" % (cache_dir, storage, max_size))
+
+    def key(self, img_old_path, img_new_path, optical_flow_type, target_size):
+        """
+        Flow is cached only for frames without augmentation (augmentation is applied to flow analytically)
+
+        :param str img_old_path: (relative) path of the old frame
+        :param str img_new_path: (relative) path of the new frame
+        :param str optical_flow_type: farn | dis | deepflow
+        :param tuple target_size: (height, width)
+        :rtype: str
+        """
+        description = '%s|%s|%s|%dx%d|%s' % (
+            img_old_path,
+            img_new_path,
+            optical_flow_type,
+            target_size[0],
+            target_size[1],
+            self.storage
+        )
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def encode(self, flow):
+        if self.storage == 'float16':
+            return flow.astype(np.float16)
+        elif self.storage == 'quantized':
+            quantized = np.rint(flow * self.QUANTIZATION_SCALE)
+            return np.clip(quantized, -32768, 32767).astype(np.int16)
+        else:
+            return flow.astype(np.float32)
+
+    def decode(self, data):
+        if data.dtype == np.int16:
+            return data.astype(np.float32) / self.QUANTIZATION_SCALE
+        return data.astype(np.float32)
+
+    def get(self, key):
+        """
+        :param str key:
+        :return: flow (height, width, 2) float32 or None when not cached
+        """
+        try:
+            data = np.load(self._path(key))
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self.decode(data)
+
+    def put(self, key, flow):
+        """
+        Atomically writes flow to the cache
+        :param str key:
+        :param flow: (height, width, 2) flow field
+        """
+        path = self._path(key)
+        sub_dir = os.path.dirname(path)
+        if not os.path.isdir(sub_dir):
+            try:
+                os.makedirs(sub_dir)
+            except OSError:
+                pass
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=sub_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, self.encode(flow))
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.max_size is not None:
+            self._account(os.path.getsize(path))
+
+    def _cached_files(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith('.npy'):
+                    yield os.path.join(root, file_name)
+
+    def _account(self, added_bytes):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(os.path.getsize(f) for f in self._cached_files())
+            else:
+                self._size += added_bytes
+
+            if self._size > self.max_size:
+                self._evict(int(self.max_size * 0.9))
+
+    def _evict(self, to_size):
+        """
+        Removes the oldest files until cache fits into `to_size` bytes
+        :param int to_size:
+        """
+        files = []
+        for path in self._cached_files():
+            try:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                # removed by another worker
+                pass
+
+        files.sort()
+        size = sum(f[1] for f in files)
+        for _, file_size, path in files:
+            if size <= to_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+
+        print("-- Flow cache evicted to %d bytes" % size)
+        self._size = size
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+
+class FrameCache:
+    """
+    Bounded in-process LRU cache of decoded frames resized to target size, key is (path, target size).
+    Frames of overlapping sequences (previous frames of more samples, more epochs) are decoded only once.
+
+    Cache is shared by threads of the process (workers of Sequence with threads), with multiprocessing
+    every worker process fills its own cache (and has its own counters).
+    Cached frames are read-only, augmentation always creates new arrays.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param int max_size: size limit of cached frames in bytes, least recently used frames are evicted
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+        print("-- Frame cache (max size %d MB)" % (max_size // (1024 * 1024)))
+
+    @staticmethod
+    def key(path, target_size):
+        return path, tuple(target_size)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def get(self, key):
+        """
+        :param tuple key: see key()
+        :return: read-only frame or None when not cached
+        """
+        with self._lock:
+            frame = self._frames.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+
+            # most recently used is at the end
+            self._frames[key] = frame
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        """
+        :param tuple key: see key()
+        :param frame: numpy array, it is made read-only
+        """
+        if frame.nbytes > self.max_size:
+            return
+
+        frame.setflags(write=False)
+        with self._lock:
+            if key in self._frames:
+                return
+
+            self._frames[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.max_size:
+                _, evicted = self._frames.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return float(self.hits) / requests if requests > 0 else 0.
+
+    def summary(self):
+        return "-- Frame cache: %d frames, %.1f/%.1f MB, hits %d, misses %d, hit rate %.3f" % (
+            len(self._frames), self.size / 1048576., self.max_size / 1048576., self.hits, self.misses, self.hit_rate())
@@ -15,9 +15,9 @@ class GTAGenerator(BaseDataGenerator):
             'n_classes': len(labels)
         }
 
-    def __init__(self, dataset_path, debug_samples=0):
+    def __init__(self, dataset_path, debug_samples=0, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'gta/')
-        super(GTAGenerator, self).__init__(dataset_path, debug_samples)
+        super(GTAGenerator, self).__init__(dataset_path, debug_samples, sparse_labels=sparse_labels)
 
     @property
     def name(self):
@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy as np
+
+
+class PackedDataset:
+    """
+    Frames and labels pre-resized to one target size, packed into contiguous memory-mapped arrays.
+    Rows are read as views into the mapped file (no decoding, no resizing).
+
+    Directory layout:
+        index.json  - target size and keys (paths relative to dataset) of rows
+        images.npy  - (n_images, height, width, 3) uint8
+        labels.npy  - (n_labels, height, width[, channels]) uint8, resized with nearest neighbour
+    """
+
+    INDEX_FILE = 'index.json'
+    IMAGES_FILE = 'images.npy'
+    LABELS_FILE = 'labels.npy'
+
+    def __init__(self, path):
+        """
+        Opens packed dataset
+        :param str path: directory with packed dataset
+        """
+        with open(os.path.join(path, self.INDEX_FILE), 'r') as fp:
+            index = json.load(fp)
+
+        self.path = path
+        self.target_size = tuple(index['target_size'])
+        self._image_rows = {key: i for i, key in enumerate(index['images'])}
+        self._label_rows = {key: i for i, key in enumerate(index['labels'])}
+
+        self.images = np.load(os.path.join(path, self.IMAGES_FILE), mmap_mode='r')
+        self.labels = None
+        if len(self._label_rows) > 0:
+            self.labels = np.load(os.path.join(path, self.LABELS_FILE), mmap_mode='r')
+
+        print("-- Packed dataset %s: %d images, %d labels of size %s" % (
+            path, len(self._image_rows), len(self._label_rows), self.target_size))
+
+    def image(self, key):
+        """
+        :param str key: path relative to dataset
+        :return: read-only view (height, width, 3) or None if not packed
+        """
+        row = self._image_rows.get(key)
+        return None if row is None else self.images[row]
+
+    def label(self, key):
+        """
+        :param str key: path relative to dataset
+        :return: read-only view (height, width[, channels]) or None if not packed
+        """
+        row = self._label_rows.get(key)
+        return None if row is None else self.labels[row]
+
+    @classmethod
+    def pack(cls, path, target_size, image_keys, label_keys, load_image, load_label, imap=map):
+        """
+        Writes packed dataset. Index is written last, so unfinished pack can't be opened.
+
+        :param str path: output directory
+        :param tuple target_size: (height, width)
+        :param list image_keys:
+        :param list label_keys:
+        :param load_image: function key -> uint8 image resized to target_size
+        :param load_label: function key -> uint8 label resized to target_size
+        :param imap: map function used for loading (e.g. multiprocessing.Pool.imap)
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        from utils import print_progress
+
+        for file_name, keys, load in [(cls.IMAGES_FILE, image_keys, load_image), (cls.LABELS_FILE, label_keys, load_label)]:
+            if len(keys) == 0:
+                continue
+
+            arr = None
+            print_progress(0, len(keys), prefix=file_name, suffix='Complete', bar_length=50)
+            for i, data in enumerate(imap(load, keys)):
+                if arr is None:
+                    arr = np.lib.format.open_memmap(
+                        os.path.join(path, file_name),
+                        mode='w+',
+                        dtype=np.uint8,
+                        shape=(len(keys),) + data.shape
+                    )
+                arr[i] = data
+                print_progress(i + 1, len(keys), prefix=file_name, suffix='Complete', bar_length=50)
+
+            arr.flush()
+            del arr
+
+        with open(os.path.join(path, cls.INDEX_FILE), 'w') as fp:
+            json.dump({
+                'target_size': list(target_size),
+                'images': list(image_keys),
+                'labels': list(label_keys)
+            }, fp)
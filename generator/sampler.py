@@ -0,0 +1,96 @@
+import random
+
+
+class EpochSampler:
+    """
+    Order of samples of every epoch, block-shuffled for locality of reads.
+
+    Samples are grouped (e.g. by city or sequence) and sorted inside groups (files of a group are close
+    on disk, rows of packed dataset are sorted by path), every group is split into contiguous blocks
+    of `block_size` samples. Every epoch the samples are shuffled within blocks and the blocks
+    are shuffled across groups, so consecutive reads stay in one block while the epoch is still shuffled.
+    Batches are built from neighbouring positions, so a batch mostly comes from one block
+    (block_size 1 is the full shuffle).
+
+    The order depends only on (seed, epoch), so it can be computed ahead by loaders and prefetchers
+    in any process (see order and stream).
+    """
+
+    def __init__(self, groups, block_size=64, shuffle=True, seed=0):
+        """
+        :param list groups: list of lists of sample indices, indices of a group in order of locality
+        :param int block_size: number of samples of a block
+        :param bool shuffle: False for the same order (groups concatenated) in every epoch
+        :param int seed:
+        """
+        self.shuffle = shuffle
+        self.seed = seed
+        self.block_size = max(1, block_size)
+        self.blocks = [
+            group[i:i + self.block_size]
+            for group in groups
+            for i in range(0, len(group), self.block_size)
+        ]
+        self.length = sum(len(block) for block in self.blocks)
+
+    @classmethod
+    def from_keys(cls, keys, block_size=64, shuffle=True, seed=0):
+        """
+        :param list keys: (group, sort key) of every sample, e.g. (city, path)
+        :rtype: EpochSampler
+        """
+        groups = {}
+        for i, (group, sort_key) in enumerate(keys):
+            groups.setdefault(group, []).append((sort_key, i))
+
+        return cls(
+            [[i for _, i in sorted(groups[group])] for group in sorted(groups)],
+            block_size=block_size,
+            shuffle=shuffle,
+            seed=seed
+        )
+
+    def __len__(self):
+        return self.length
+
+    def order(self, epoch):
+        """
+        :param int epoch:
+        :return list: sample indices of the epoch
+        """
+        if not self.shuffle:
+            return [i for block in self.blocks for i in block]
+
+        rng = random.Random(self.seed * 100003 + epoch)
+        blocks = [list(block) for block in self.blocks]
+        for block in blocks:
+            rng.shuffle(block)
+        rng.shuffle(blocks)
+        return [i for block in blocks for i in block]
+
+    def stream(self, epoch=0):
+        """
+        Endless stream of sample indices of successive epochs
+        :param int epoch: first epoch
+        :return: generator of (epoch, sample index)
+        """
+        while True:
+            for i in self.order(epoch):
+                yield epoch, i
+            epoch += 1
+
+
+if __name__ == '__main__':
+    # every sample exactly once per epoch, blocks stay within groups
+    keys = [('city_%d' % (i % 3), 'frame_%03d' % i) for i in range(100)]
+    sampler = EpochSampler.from_keys(keys, block_size=8, seed=1)
+
+    for epoch in range(3):
+        order = sampler.order(epoch)
+        assert sorted(order) == list(range(len(keys)))
+        assert order == sampler.order(epoch)
+        print("-- epoch %d: %s" % (epoch, [keys[i][0] for i in order[:16]]))
+
+    stream = sampler.stream()
+    assert [next(stream)[1] for _ in range(len(keys))] == sampler.order(0)
+    assert next(stream) == (1, sampler.order(1)[0])
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+class Stager:
+    """
+    Copies dataset files to local scratch ahead of their use, so the network storage is not read
+    synchronously by the data loader (the first epoch especially).
+
+    Loaders publish the order of files of the epoch by `schedule` (one schedule per split, e.g. shuffled train
+    and validation), a thread pool copies files of up to `read_ahead` samples after the current position
+    of every schedule. The position follows files requested through `local_path` in this process,
+    loaders in other processes (multiprocessing workers) report progress by `advance`.
+    Forked workers don't stage, they only find copies staged by the main process on scratch.
+
+    Files are keyed by path relative to dataset (the same layout is kept on scratch), copies are written
+    to temporary files and atomically renamed, so a file on scratch is always complete.
+    Total size of staged files is limited by capacity, the least recently used files are evicted.
+
+    Scratch may be shared (e.g. $SCRATCH of the node), so files are staged into an own subdirectory per dataset
+    marked by MARKER_FILE, only this subdirectory is scanned and evicted.
+    """
+
+    MARKER_FILE = '.staging'
+
+    def __init__(self, dataset_path, scratch_dir, capacity=None, workers=4, read_ahead=512):
+        """
+        :param str dataset_path: root of dataset files
+        :param str scratch_dir: local directory, copies are staged into its subdirectory of the dataset
+        :param int capacity: size limit of staged files in bytes (None for unlimited)
+        :param int workers: number of copying threads
+        :param int read_ahead: number of samples staged ahead of the position of a schedule
+        """
+        self.dataset_path = dataset_path
+        dataset_hash = hashlib.md5(os.path.abspath(dataset_path).encode('utf-8')).hexdigest()[:12]
+        self.scratch_dir = os.path.join(scratch_dir, 'staging_' + dataset_hash)
+        self.capacity = capacity
+        self.read_ahead = read_ahead
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        # key -> size in bytes, least recently used first
+        self._staged = OrderedDict()
+        # name -> schedule (see schedule)
+        self._schedules = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(workers)
+        self._pid = os.getpid()
+
+        self._claim()
+        self._scan()
+        print("-- Staging %s to %s (capacity %s, %d files already staged)" % (
+            dataset_path, self.scratch_dir, capacity, len(self._staged)))
+
+    def _key(self, path):
+        """
+        :return: path relative to dataset or None for files outside of dataset
+        """
+        key = os.path.relpath(path, self.dataset_path)
+        if key.startswith(os.pardir):
+            return None
+        return key
+
+    def _staged_path(self, key):
+        return os.path.join(self.scratch_dir, key)
+
+    def _claim(self):
+        """
+        Creates staging directory with marker, or checks that existing directory was created by staging
+        """
+        marker_path = os.path.join(self.scratch_dir, self.MARKER_FILE)
+        if not os.path.isdir(self.scratch_dir):
+            try:
+                os.makedirs(self.scratch_dir)
+            except OSError:
+                # created by another process meanwhile
+                pass
+        elif not os.path.exists(marker_path) and len(os.listdir(self.scratch_dir)) > 0:
+            raise ValueError("Directory %s exists and wasn't created by staging" % self.scratch_dir)
+
+        with open(marker_path, 'w') as fp:
+            fp.write(os.path.abspath(self.dataset_path) + '\n')
+
+    def _scan(self):
+        """
+        Registers files staged by previous runs, oldest first
+        """
+        files = []
+        for root, dirs, file_names in os.walk(self.scratch_dir):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                if file_name.endswith('.tmp') or path == os.path.join(self.scratch_dir, self.MARKER_FILE):
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, os.path.relpath(path, self.scratch_dir), stat.st_size))
+
+        with self._lock:
+            for _, key, size in sorted(files):
+                self._staged[key] = size
+                self.size += size
+            self._evict()
+
+    def schedule(self, name, samples, epoch=0):
+        """
+        Replaces schedule of files (e.g. new epoch order), staging starts from the beginning
+
+        :param str name: name of the schedule (e.g. train, val)
+        :param list samples: list of lists of file paths of samples in order of use
+        :param int epoch: epoch of the order, progress of other epochs is ignored (see advance)
+        """
+        index = {}
+        keys = []
+        for i, paths in enumerate(samples):
+            sample_keys = [key for key in (self._key(path) for path in paths) if key is not None]
+            for key in sample_keys:
+                index.setdefault(key, i)
+            keys.append(sample_keys)
+
+        with self._lock:
+            self._schedules[name] = {'keys': keys, 'index': index, 'epoch': epoch, 'position': 0, 'next': 0}
+            self._fill(name)
+
+    def advance(self, name, position, epoch):
+        """
+        Progress of consumer, batches of previous epoch are still consumed when the next epoch is scheduled
+        (enqueuer reschedules as soon as all batches are built)
+
+        :param str name: name of the schedule
+        :param int position: number of samples of the epoch already used
+        :param int epoch: epoch of the consumed samples
+        """
+        with self._lock:
+            schedule = self._schedules.get(name)
+            if schedule is not None and schedule['epoch'] == epoch and position > schedule['position']:
+                schedule['position'] = position
+                self._fill(name)
+
+    def _fill(self, name):
+        """
+        Submits copies of samples up to read ahead (called with lock)
+        """
+        schedule = self._schedules[name]
+        end = min(len(schedule['keys']), schedule['position'] + self.read_ahead)
+        while schedule['next'] < end:
+            for key in schedule['keys'][schedule['next']]:
+                if key not in self._staged:
+                    self._pool.apply_async(self._stage, (key,))
+            schedule['next'] += 1
+
+    def local_path(self, path):
+        """
+        :param str path: path of dataset file
+        :return str: path of staged copy or original path when the file is not staged yet
+        """
+        key = self._key(path)
+        if key is None:
+            return path
+
+        if os.getpid() != self._pid:
+            # forked worker, threads of the pool and state of staged files are not shared
+            staged_path = self._staged_path(key)
+            return staged_path if os.path.exists(staged_path) else path
+
+        with self._lock:
+            for name, schedule in self._schedules.items():
+                # reads out of staged window (e.g. late reads of previous epoch) don't move the position
+                i = schedule['index'].get(key)
+                if i is not None and schedule['position'] < i + 1 <= schedule['next']:
+                    schedule['position'] = i + 1
+                    self._fill(name)
+
+            if key in self._staged:
+                self._staged[key] = self._staged.pop(key)
+                self.hits += 1
+                return self._staged_path(key)
+
+            self.misses += 1
+            return path
+
+    def _stage(self, key):
+        """
+        Copies file to scratch (in thread pool)
+        """
+        with self._lock:
+            if key in self._staged:
+                return
+
+        src = os.path.join(self.dataset_path, key)
+        dst = self._staged_path(key)
+        dst_dir = os.path.dirname(dst)
+        try:
+            if not os.path.isdir(dst_dir):
+                try:
+                    os.makedirs(dst_dir)
+                except OSError:
+                    pass
+
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=dst_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f, open(src, 'rb') as f_src:
+                    shutil.copyfileobj(f_src, f)
+                os.rename(tmp_path, dst)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            # file is read from dataset
+            print("-- staging of %s failed: %s" % (key, e))
+            return
+
+        with self._lock:
+            if key not in self._staged:
+                self._staged[key] = os.path.getsize(dst)
+                self.size += self._staged[key]
+                self._evict()
+
+    def _evict(self):
+        """
+        Removes least recently used files until staged files fit into capacity (called with lock)
+        """
+        if self.capacity is None:
+            return
+
+        while self.size > self.capacity and len(self._staged) > 0:
+            key, size = self._staged.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._staged_path(key))
+            except OSError:
+                pass
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return float(self.hits) / requests if requests > 0 else 0.
+
+    def summary(self):
+        return "-- Staging: %d files, %.1f MB, hits %d, misses %d, hit rate %.3f" % (
+            len(self._staged), self.size / 1048576., self.hits, self.misses, self.hit_rate())
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
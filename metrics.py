@@ -75,3 +75,12 @@ def mean_iou(y_true, y_pred, smooth=None, axis=-1):
     iou = (intersection + smooth) / ((union_per_class - intersection) + smooth)
 
     return K.mean(iou)
+
+
+def sparse_mean_iou(y_true, y_pred, smooth=None):
+    """
+    mean_iou for sparse ground truth (class index per pixel, shape (batch, height, width, 1))
+    """
+    n_classes = K.int_shape(y_pred)[-1]
+    y_true_one_hot = K.one_hot(K.cast(K.flatten(y_true), 'int32'), num_classes=n_classes)
+    return mean_iou(y_true_one_hot, y_pred, smooth=smooth)
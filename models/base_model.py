@@ -2,6 +2,9 @@ from abc import ABCMeta, abstractmethod
 
 import keras.utils
 from keras import optimizers
+from keras.layers import Input
+
+from layers import Cast
 
 
 class BaseModel:
@@ -17,17 +20,22 @@ class BaseModel:
 
         return keras.models.model_from_json(json_string, custom_objects=custom_objects)
 
-    def __init__(self, target_size, n_classes, debug_samples=0, for_training=True, from_json=None):
+    def __init__(self, target_size, n_classes, debug_samples=0, for_training=True, from_json=None, sparse_labels=False,
+                 input_dtype='float32'):
         """
         :param tuple target_size: (height, width)
         :param int n_classes: number of classes
         :param bool is_debug: turns off regularization
+        :param bool sparse_labels: targets are class index maps instead of one-hot tensors
+        :param str input_dtype: dtype of frames and flow fed to the model (float16 is cast to float32 on the device)
         """
         self.target_size = target_size
         self.n_classes = n_classes
         self.debug_samples = debug_samples
         self.is_debug = debug_samples > 0
         self.training_phase = for_training
+        self.sparse_labels = sparse_labels
+        self.input_dtype = input_dtype
 
         self._prepare()
         if from_json is not None:
@@ -42,6 +50,20 @@ class BaseModel:
         """
         pass
 
+    def typed_input(self, shape, name=None):
+        """
+        Model input of `input_dtype`, lower precision inputs are cast to float32 right after the input
+
+        :param tuple shape: shape without batch dimension
+        :param str name:
+        :return tuple: (input of the model, float32 tensor for the layers)
+        """
+        inp = Input(shape=shape, name=name, dtype=self.input_dtype)
+        if self.input_dtype == 'float32':
+            return inp, inp
+
+        return inp, Cast('float32', name=None if name is None else name + '_cast')(inp)
+
     def make_multi_gpu(self, n_gpu):
         from keras.utils import multi_gpu_model
         self._model = multi_gpu_model(self._model, n_gpu)
@@ -73,6 +95,21 @@ class BaseModel:
 
         return self
 
+    def load_for_inference(self, filepath):
+        """
+        Loads weights for prediction only. Model is not compiled (no optimizer, loss or metrics are built)
+        and its predict function is created at once, so it stays ready for all following predictions.
+
+        :param str filepath: hdf5 file with weights
+        :return: self (for convenience)
+        """
+        self._model.load_weights(
+            filepath=filepath,
+            by_name=True
+        )
+        self._model._make_predict_function()
+        return self
+
     @abstractmethod
     def _create_model(self):
         """
@@ -144,7 +181,7 @@ class BaseModel:
     def metrics(self):
         import metrics
         return [
-            metrics.mean_iou
+            metrics.sparse_mean_iou if self.sparse_labels else metrics.mean_iou
         ]
 
     @staticmethod
@@ -152,7 +189,9 @@ class BaseModel:
         """dictionary of custom objects (as per keras definition)"""
         import metrics
         return {
-            'mean_iou': metrics.mean_iou
+            'mean_iou': metrics.mean_iou,
+            'sparse_mean_iou': metrics.sparse_mean_iou,
+            'Cast': Cast
         }
 
     lr_params = None
@@ -182,6 +221,12 @@ class BaseModel:
         params = self._optimizer_params()
         return optimizers.Adam(lr=params['lr'], decay=params['decay'])
 
+    def loss(self):
+        if self.sparse_labels:
+            return keras.losses.sparse_categorical_crossentropy
+        else:
+            return keras.losses.categorical_crossentropy
+
     def loss_weights(self):
         return None
 
@@ -192,9 +237,10 @@ class BaseModel:
         print("-- Optimizer: " + type(self.optimizer()).__name__)
         print("---- Params: ", self._optimizer_params())
         print("---- For Training: ", self.training_phase)
+        print("---- Sparse labels: ", self.sparse_labels)
 
         self._model.compile(
-            loss=keras.losses.categorical_crossentropy,
+            loss=self.loss(),
             optimizer=self.optimizer(),
             metrics=self.metrics(),
             loss_weights=self.loss_weights()
@@ -251,8 +251,7 @@ class ICNet(BaseModel):
             return [out]
 
     def _create_model(self):
-        inp = Input(shape=self.target_size + (3,))
-        x = inp
+        inp, x = self.typed_input(self.target_size + (3,))
 
         # (1/2)
         branch_half = self.branch_half(self.input_shape)
@@ -305,7 +304,7 @@ class ICNet(BaseModel):
 
         return {
             'out': [
-                metrics.mean_iou,
+                metrics.sparse_mean_iou if self.sparse_labels else metrics.mean_iou,
             ]
         }
 
@@ -10,14 +10,50 @@ from layers.warp import *
 class ICNetWarp(ICNet):
     warp_decoder = []
 
+    # how previous frame is processed in training (see __init__)
+    OLD_FRAME_MODES = ['shared', 'frozen', 'input']
+
+    # features of previous frame warped at position of warp_decoder (names of layers in ICNet)
+    WARP_FEATURES = ['branch_1', 'conv3_1_sub2_proj_bn', 'branch_14']
+
+    def __init__(self, target_size, n_classes, debug_samples=0, for_training=True, from_json=None, sparse_labels=False,
+                 old_frame='shared', input_dtype='float32', warp_method='gather'):
+        """
+        :param str old_frame: in training, features of previous frame are computed by the same branches
+            and trained through both frames (shared), or without gradient (frozen),
+            so only current frame path, FlowCNN and LinearCombination get gradients through warping,
+            or they are inputs (input) as in inference, fed from feature cache (see precompute_features.py)
+        :param str warp_method: implementation of warping of all NetWarp modules (see Warp.METHODS)
+        """
+        if old_frame not in self.OLD_FRAME_MODES:
+            raise ValueError("Unknown old frame mode %s, use one of %s" % (old_frame, self.OLD_FRAME_MODES))
+
+        if warp_method not in Warp.METHODS:
+            raise ValueError("Unknown warp method %s, use one of %s" % (warp_method, Warp.METHODS))
+
+        self.old_frame = old_frame
+        self.warp_method = warp_method
+        super(ICNetWarp, self).__init__(target_size, n_classes, debug_samples, for_training, from_json, sparse_labels,
+                                        input_dtype)
+
+    @property
+    def prev_features_as_input(self):
+        return not self.training_phase or self.old_frame == 'input'
+
+    def prev_feature_names(self):
+        """
+        :return list: names of previous frame features in order of model inputs (after frames and flow)
+        """
+        return [self.WARP_FEATURES[i] for i in sorted(set(self.warp_decoder))]
+
     def _create_model(self):
-        img_old = Input(shape=self.input_shape, name='data_old')
-        img_new = Input(shape=self.input_shape, name='data_new')
-        flo = Input(shape=self.target_size + (2,), name='data_flow')
+        img_old_input, img_old = self.typed_input(self.input_shape, name='data_old')
+        img_new_input, img_new = self.typed_input(self.input_shape, name='data_new')
+        flo_input, flo = self.typed_input(self.target_size + (2,), name='data_flow')
 
-        all_inputs = [img_old, img_new, flo]
+        all_inputs = [img_old_input, img_new_input, flo_input]
 
-        transformed_flow = flow_cnn(self.target_size)(all_inputs)
+        transformed_flow = flow_cnn(self.target_size)([img_old, img_new, flo])
 
         x = img_new
         x_old = img_old
@@ -34,12 +70,12 @@ class ICNetWarp(ICNet):
         branch_quarter_out = y
 
         if 2 in self.warp_decoder:
-            if self.training_phase:
-                y_old = branch_quarter(z_old)
+            if not self.prev_features_as_input:
+                y_old = old_frame_features(branch_quarter(z_old), self.old_frame)
             else:
                 input_branch_quarter = Input(branch_quarter.output_shape[1:], name='prev_branch_14')
                 y_old = input_branch_quarter
-            y = netwarp(y_old, y, transformed_flow)
+            y = netwarp(y_old, y, transformed_flow, self.warp_method)
 
         pyramid_block = self.pyramid_block(branch_quarter.output_shape[1:])
         aux_1 = pyramid_block(y)
@@ -54,13 +90,13 @@ class ICNetWarp(ICNet):
         y_ = conv3_1_sub2_proj_bn(conv3_1_sub2_proj(z))
 
         if 1 in self.warp_decoder:
-            if self.training_phase:
-                y_old_ = conv3_1_sub2_proj_bn(conv3_1_sub2_proj(z_old))
+            if not self.prev_features_as_input:
+                y_old_ = old_frame_features(conv3_1_sub2_proj_bn(conv3_1_sub2_proj(z_old)), self.old_frame)
             else:
                 input_branch_half = Input(conv3_1_sub2_proj_bn.output_shape[1:], name='prev_conv3_1_sub2_proj_bn')
                 y_old_ = input_branch_half
 
-            y_ = netwarp(y_old_, y_, transformed_flow)
+            y_ = netwarp(y_old_, y_, transformed_flow, self.warp_method)
 
         y = Add(name='sub24_sum')([y, y_])
         y = Activation('relu', name='sub24_sum/relu')(y)
@@ -76,13 +112,13 @@ class ICNetWarp(ICNet):
         branch_full_out = y
 
         if 0 in self.warp_decoder:
-            if self.training_phase:
-                y_old = block_0(x_old)
+            if not self.prev_features_as_input:
+                y_old = old_frame_features(block_0(x_old), self.old_frame)
             else:
                 input_branch_full = Input(block_0.output_shape[1:], name='prev_branch_1')
                 y_old = input_branch_full
 
-            y = netwarp(y_old, y, transformed_flow)
+            y = netwarp(y_old, y, transformed_flow, self.warp_method)
 
         y = Add(name='sub12_sum')([y, y_])
         y = Activation('relu', name='sub12_sum/relu')(y)
@@ -90,15 +126,20 @@ class ICNetWarp(ICNet):
 
         outputs = self.out_block(y, aux_1, aux_2)
 
-        if not self.training_phase:
+        if self.prev_features_as_input:
             if 0 in self.warp_decoder:
                 all_inputs.append(input_branch_full)
-                outputs.append(branch_full_out)
             if 1 in self.warp_decoder:
                 all_inputs.append(input_branch_half)
-                outputs.append(branch_half_out)
             if 2 in self.warp_decoder:
                 all_inputs.append(input_branch_quarter)
+
+        if not self.training_phase:
+            if 0 in self.warp_decoder:
+                outputs.append(branch_full_out)
+            if 1 in self.warp_decoder:
+                outputs.append(branch_half_out)
+            if 2 in self.warp_decoder:
                 outputs.append(branch_quarter_out)
 
         return Model(inputs=all_inputs, outputs=outputs)
@@ -108,7 +149,8 @@ class ICNetWarp(ICNet):
         custom_objects = ICNet.get_custom_objects()
         custom_objects.update({
             'Warp': Warp,
-            'LinearCombination': LinearCombination
+            'LinearCombination': LinearCombination,
+            'StopGradient': StopGradient
         })
         return custom_objects
 
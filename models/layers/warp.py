@@ -1,5 +1,6 @@
 import keras
 import keras.backend as K
+import numpy as np
 import tensorflow as tf
 from keras.constraints import Constraint
 from keras.engine import Layer
@@ -35,6 +36,39 @@ class ResizeBilinear(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+class StopGradient(Layer):
+    """
+    Identity in forward pass, no gradient flows back through it
+    """
+
+    def call(self, inputs, **kwargs):
+        return K.stop_gradient(inputs)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
+class Cast(Layer):
+    """
+    Casts inputs to dtype (e.g. float16 inputs to float32 on the device)
+    """
+
+    def __init__(self, target_dtype='float32', **kwargs):
+        self.target_dtype = target_dtype
+        super(Cast, self).__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        return K.cast(inputs, self.target_dtype)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {'target_dtype': self.target_dtype}
+        base_config = super(Cast, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 class MinMaxConstraint(Constraint):
     def __init__(self, min=0., max=1.):
         self.min = min
@@ -119,34 +153,65 @@ def flow_cnn(input_shape):
     return Model([img_old, img_new, flo], transformed_flow, name='FlowCNN')
 
 
-def netwarp(layer_old, layer_new, transformed_flow):
+def old_frame_features(layer_old, old_frame='shared'):
+    """
+    Features of the previous frame used for warping in training
+    :param layer_old: output of backbone layer for previous frame
+    :param str old_frame: shared - trained through both frames, frozen - backbone is trained only through current frame
+    :return:
+    """
+    if old_frame == 'frozen':
+        return StopGradient(name=get_layer_name('old_frame_stop_gradient'))(layer_old)
+    return layer_old
+
+
+def netwarp(layer_old, layer_new, transformed_flow, warp_method='gather'):
     """
     NetWarp module with linear combination
     :param layer_old:
     :param layer_new:
     :param transformed_flow:
+    :param str warp_method: see Warp.METHODS
     :return:
     """
     out_size = layer_old.get_shape().as_list()[1:3]
     resized_flow = ResizeBilinear(out_size)(transformed_flow)
 
-    warped = Warp()([layer_old, resized_flow])
+    warped = Warp(method=warp_method)([layer_old, resized_flow])
     combined = LinearCombination()([layer_new, warped])
     return combined
 
 
 class Warp(Layer):
-    def __init__(self, resize=False, **kwargs):
+    """
+    Warping methods:
+        gather_nd - original implementation, four gather_nd with tiled batch indices
+        gather    - same sampling, cached base grid and four 1-D gathers from flattened image
+        resampler - fused bilinear sampling of tf.contrib.resampler (when available, else gather);
+                    samples out of image are zero instead of clipped, so it differs at borders
+    """
+
+    METHODS = ['gather_nd', 'gather', 'resampler']
+
+    # base grids (1, H, W, 2) shared by layers of the same size
+    _grids = {}
+
+    def __init__(self, resize=False, method='gather', **kwargs):
         """
         Warping layer. Expects list of 2 shapes [img, optical_flow]
         :param resize:
+        :param str method: one of Warp.METHODS
         :param kwargs:
         """
+        if method not in self.METHODS:
+            raise ValueError("Unknown warp method %s, use one of %s" % (method, self.METHODS))
+
         super(Warp, self).__init__(**kwargs)
         self.resize = resize
+        self.method = method
 
     def get_config(self):
-        config = {'resize': self.resize}
+        config = {'resize': self.resize, 'method': self.method}
         base_config = super(Warp, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
@@ -164,8 +229,99 @@ class Warp(Layer):
         if self.resize:
             flow = ResizeBilinear(self.out_size)(flow)
 
-        out = self.tf_warp(img, flow, self.out_size)
-        return out
+        return self.warp(img, flow, self.out_size, self.method)
+
+    @classmethod
+    def warp(cls, img, flow, size, method='gather'):
+        """
+        :param img: tensor (B, H, W, C)
+        :param flow: tensor (B, H, W, 2)
+        :param tuple size: (H, W)
+        :param str method: one of Warp.METHODS
+        :return: warped tensor (B, H, W, C)
+        """
+        if method == 'resampler':
+            resampler = cls._contrib_resampler()
+            if resampler is not None:
+                return resampler(img, cls.base_grid(size) + flow)
+            method = 'gather'
+
+        if method == 'gather':
+            return cls.tf_warp_gather(img, flow, size)
+
+        return cls.tf_warp(img, flow, size)
+
+    @staticmethod
+    def _contrib_resampler():
+        try:
+            from tensorflow.contrib.resampler import resampler
+            return resampler
+        except ImportError:
+            print("-- tf.contrib.resampler is not available, warping with gather")
+            return None
+
+    @classmethod
+    def base_grid(cls, size):
+        """
+        :param tuple size: (H, W)
+        :return: float32 array (1, H, W, 2) with (x, y) coordinates of pixels
+        """
+        size = (int(size[0]), int(size[1]))
+        if size not in cls._grids:
+            x, y = np.meshgrid(np.arange(size[1], dtype=np.float32), np.arange(size[0], dtype=np.float32))
+            cls._grids[size] = np.stack([x, y], axis=-1)[np.newaxis]
+        return cls._grids[size]
+
+    @classmethod
+    def tf_warp_gather(cls, img, flow, size):
+        """
+        Same sampling as tf_warp, but with constant base grid and 1-D gathers from flattened image
+        (no meshgrid and no index tensors with tiled batch indices)
+
+        :param img: tensor (B, H, W, C)
+        :param flow: tensor (B, H, W, 2)
+        :param tuple size: (H, W)
+        :return: warped tensor (B, H, W, C)
+        """
+        H, W = int(size[0]), int(size[1])
+
+        flows = tf.constant(cls.base_grid(size)) + flow
+        x = flows[:, :, :, 0]
+        y = flows[:, :, :, 1]
+
+        x0 = tf.cast(x, tf.int32)
+        y0 = tf.cast(y, tf.int32)
+        x1 = tf.clip_by_value(x0 + 1, 0, W - 1)
+        y1 = tf.clip_by_value(y0 + 1, 0, H - 1)
+        x0 = tf.clip_by_value(x0, 0, W - 1)
+        y0 = tf.clip_by_value(y0, 0, H - 1)
+
+        channels = img.get_shape().as_list()[-1]
+        if channels is None:
+            channels = tf.shape(img)[-1]
+        flat = tf.reshape(img, [-1, channels])
+
+        batch_size = tf.shape(img)[0]
+        base = tf.reshape(tf.range(batch_size) * (H * W), [-1, 1, 1])
+        row_0 = base + y0 * W
+        row_1 = base + y1 * W
+
+        Ia = tf.gather(flat, row_0 + x0)
+        Ib = tf.gather(flat, row_1 + x0)
+        Ic = tf.gather(flat, row_0 + x1)
+        Id = tf.gather(flat, row_1 + x1)
+
+        x0 = tf.cast(x0, tf.float32)
+        x1 = tf.cast(x1, tf.float32)
+        y0 = tf.cast(y0, tf.float32)
+        y1 = tf.cast(y1, tf.float32)
+
+        wa = tf.expand_dims((x1 - x) * (y1 - y), axis=3)
+        wb = tf.expand_dims((x1 - x) * (y - y0), axis=3)
+        wc = tf.expand_dims((x - x0) * (y1 - y), axis=3)
+        wd = tf.expand_dims((x - x0) * (y - y0), axis=3)
+
+        return tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
 
     @staticmethod
     def tf_warp(img, flow, size):
@@ -270,8 +426,85 @@ class Warp(Layer):
         out = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
         return out
 
+    @staticmethod
+    def np_warp(img, flow):
+        """
+        NumPy implementation of tf_warp for host-side warping (generators, visualization),
+        with the same sampling: coordinates are truncated, clipped to image and weighted bilinearly
+
+        :param img: (height, width, channels) or (batch, height, width, channels)
+        :param flow: (height, width, 2) or (batch, height, width, 2)
+        :return: warped image float32 of the same shape as img
+        """
+        batched = img.ndim == 4
+        if not batched:
+            img = img[np.newaxis]
+            flow = flow[np.newaxis]
+
+        batch_size, H, W = flow.shape[:3]
+        channels = img.shape[-1]
+
+        grid_x, grid_y = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32))
+        x = grid_x + flow[..., 0].astype(np.float32)
+        y = grid_y + flow[..., 1].astype(np.float32)
+
+        # cast truncates towards zero (as tf.cast)
+        x0 = x.astype(np.int32)
+        y0 = y.astype(np.int32)
+        x1 = np.clip(x0 + 1, 0, W - 1)
+        y1 = np.clip(y0 + 1, 0, H - 1)
+        x0 = np.clip(x0, 0, W - 1)
+        y0 = np.clip(y0, 0, H - 1)
+
+        # gather from flattened image
+        flat = img.reshape(-1, channels).astype(np.float32)
+        base = (np.arange(batch_size, dtype=np.int32) * (H * W))[:, np.newaxis, np.newaxis]
+        Ia = flat[base + y0 * W + x0]
+        Ib = flat[base + y1 * W + x0]
+        Ic = flat[base + y0 * W + x1]
+        Id = flat[base + y1 * W + x1]
+
+        x0 = x0.astype(np.float32)
+        x1 = x1.astype(np.float32)
+        y0 = y0.astype(np.float32)
+        y1 = y1.astype(np.float32)
+
+        wa = ((x1 - x) * (y1 - y))[..., np.newaxis]
+        wb = ((x1 - x) * (y - y0))[..., np.newaxis]
+        wc = ((x - x0) * (y1 - y))[..., np.newaxis]
+        wd = ((x - x0) * (y - y0))[..., np.newaxis]
+
+        out = wa * Ia + wb * Ib + wc * Ic + wd * Id
+        return out if batched else out[0]
+
+
+def check_np_warp(size=(256, 512), channels=3, batch_size=2):
+    """
+    Parity check of Warp.np_warp against Warp.tf_warp on random images and flows (also out of image)
+    """
+    import time
+
+    img = np.random.rand(batch_size, size[0], size[1], channels).astype(np.float32)
+    flow = (np.random.randn(batch_size, size[0], size[1], 2) * 20).astype(np.float32)
+
+    with tf.Session() as sess:
+        a = tf.placeholder(tf.float32, shape=[None, None, None, channels])
+        flow_vec = tf.placeholder(tf.float32, shape=[None, None, None, 2])
+        warp_graph = Warp.tf_warp(a, flow_vec, size)
+        expected = sess.run(warp_graph, feed_dict={a: img, flow_vec: flow})
+
+    start = time.time()
+    out = Warp.np_warp(img, flow)
+    elapsed = time.time() - start
+
+    diff = np.max(np.abs(out - expected))
+    print("-- np_warp max abs difference %g (%.1f ms)" % (diff, elapsed * 1000))
+    assert diff < 1e-4, "np_warp differs from tf_warp"
+
 
 if __name__ == '__main__':
+    check_np_warp()
+
     from IPython.display import SVG
     from keras.utils.vis_utils import model_to_dot
 
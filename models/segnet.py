@@ -36,13 +36,13 @@ class SegNet(BaseModel):
         return Model(input, out, name='up_conv_block_%d' % block_id)
 
     def _create_model(self):
-        input = Input(shape=self.target_size + (3,), name='data_0')
+        input, x = self.typed_input(self.target_size + (3,), name='data_0')
 
         block_0 = self.block_model(self.input_shape, 64, 1, True)
         block_1 = self.block_model(block_0.output_shape[1:], 128, 2, True)
         block_2 = self.block_model(block_1.output_shape[1:], 256, 3, True)
         block_3 = self.block_model(block_2.output_shape[1:], 512, 4, False)
-        out = block_0(input)
+        out = block_0(x)
         out = block_1(out)
         out = block_2(out)
         out = block_3(out)
@@ -8,13 +8,49 @@ from segnet import SegNet
 class SegNetWarp(SegNet):
     warp_decoder = []
 
+    # how previous frame is processed in training (see __init__)
+    OLD_FRAME_MODES = ['shared', 'frozen', 'input']
+
+    # features of previous frame warped at position of warp_decoder (names of layers in SegNet)
+    WARP_FEATURES = ['conv_block_1', 'conv_block_2', 'conv_block_3', 'conv_block_4']
+
+    def __init__(self, target_size, n_classes, debug_samples=0, for_training=True, from_json=None, sparse_labels=False,
+                 old_frame='shared', input_dtype='float32', warp_method='gather'):
+        """
+        :param str old_frame: in training, features of previous frame are computed by the same blocks
+            and trained through both frames (shared), or without gradient (frozen),
+            so only current frame path, FlowCNN and LinearCombination get gradients through warping,
+            or they are inputs (input) as in inference, fed from feature cache (see precompute_features.py)
+        :param str warp_method: implementation of warping of all NetWarp modules (see Warp.METHODS)
+        """
+        if old_frame not in self.OLD_FRAME_MODES:
+            raise ValueError("Unknown old frame mode %s, use one of %s" % (old_frame, self.OLD_FRAME_MODES))
+
+        if warp_method not in Warp.METHODS:
+            raise ValueError("Unknown warp method %s, use one of %s" % (warp_method, Warp.METHODS))
+
+        self.old_frame = old_frame
+        self.warp_method = warp_method
+        super(SegNetWarp, self).__init__(target_size, n_classes, debug_samples, for_training, from_json, sparse_labels,
+                                         input_dtype)
+
+    @property
+    def prev_features_as_input(self):
+        return not self.training_phase or self.old_frame == 'input'
+
+    def prev_feature_names(self):
+        """
+        :return list: names of previous frame features in order of model inputs (after frames and flow)
+        """
+        return [self.WARP_FEATURES[i] for i in sorted(set(self.warp_decoder))]
+
     def _create_model(self):
-        img_old = Input(self.input_shape, name='data_old')
-        img_new = Input(self.input_shape, name='data_new')
-        flo = Input(shape=self.target_size + (2,), name='data_flow')
+        img_old_input, img_old = self.typed_input(self.input_shape, name='data_old')
+        img_new_input, img_new = self.typed_input(self.input_shape, name='data_new')
+        flo_input, flo = self.typed_input(self.target_size + (2,), name='data_flow')
 
-        all_inputs = [img_old, img_new, flo]
-        transformed_flow = flow_cnn(self.target_size)(all_inputs)
+        all_inputs = [img_old_input, img_new_input, flo_input]
+        transformed_flow = flow_cnn(self.target_size)([img_old, img_new, flo])
 
         # encoder
         block_0 = self.block_model(self.input_shape, 64, 1, True)
@@ -27,52 +63,52 @@ class SegNetWarp(SegNet):
         old_out = block_0(img_old)
 
         if 0 in self.warp_decoder:
-            if not self.training_phase:
+            if self.prev_features_as_input:
                 input_block_0 = Input(block_0.output_shape[1:], name='prev_conv_block_1')
                 old_branch = input_block_0
             else:
-                old_branch = old_out
+                old_branch = old_frame_features(old_out, self.old_frame)
 
-            out = netwarp(old_branch, out, transformed_flow)
+            out = netwarp(old_branch, out, transformed_flow, self.warp_method)
 
         out = block_1(out)
         block_1_out = out
         old_out = block_1(old_out)
 
         if 1 in self.warp_decoder:
-            if not self.training_phase:
+            if self.prev_features_as_input:
                 input_block_1 = Input(block_1.output_shape[1:], name='prev_conv_block_2')
                 old_branch = input_block_1
             else:
-                old_branch = old_out
+                old_branch = old_frame_features(old_out, self.old_frame)
 
-            out = netwarp(old_branch, out, transformed_flow)
+            out = netwarp(old_branch, out, transformed_flow, self.warp_method)
 
         out = block_2(out)
         block_2_out = out
         old_out = block_2(old_out)
 
         if 2 in self.warp_decoder:
-            if not self.training_phase:
+            if self.prev_features_as_input:
                 input_block_2 = Input(block_2.output_shape[1:], name='prev_conv_block_3')
                 old_branch = input_block_2
             else:
-                old_branch = old_out
+                old_branch = old_frame_features(old_out, self.old_frame)
 
-            out = netwarp(old_branch, out, transformed_flow)
+            out = netwarp(old_branch, out, transformed_flow, self.warp_method)
 
         out = block_3(out)
         block_3_out = out
         old_out = block_3(old_out)
 
         if 3 in self.warp_decoder:
-            if not self.training_phase:
+            if self.prev_features_as_input:
                 input_block_3 = Input(block_3.output_shape[1:], name='prev_conv_block_4')
                 old_branch = input_block_3
             else:
-                old_branch = old_out
+                old_branch = old_frame_features(old_out, self.old_frame)
 
-            out = netwarp(old_branch, out, transformed_flow)
+            out = netwarp(old_branch, out, transformed_flow, self.warp_method)
 
         # decoder
         out = Convolution2D(512, self._kernel_size, padding='same')(out)
@@ -94,18 +130,24 @@ class SegNetWarp(SegNet):
 
         outputs = [out]
 
-        if not self.training_phase:
+        if self.prev_features_as_input:
             if 0 in self.warp_decoder:
                 all_inputs.append(input_block_0)
-                outputs.append(block_0_out)
             if 1 in self.warp_decoder:
                 all_inputs.append(input_block_1)
-                outputs.append(block_1_out)
             if 2 in self.warp_decoder:
                 all_inputs.append(input_block_2)
-                outputs.append(block_2_out)
             if 3 in self.warp_decoder:
                 all_inputs.append(input_block_3)
+
+        if not self.training_phase:
+            if 0 in self.warp_decoder:
+                outputs.append(block_0_out)
+            if 1 in self.warp_decoder:
+                outputs.append(block_1_out)
+            if 2 in self.warp_decoder:
+                outputs.append(block_2_out)
+            if 3 in self.warp_decoder:
                 outputs.append(block_3_out)
 
         model = Model(inputs=all_inputs, outputs=outputs)
@@ -117,7 +159,8 @@ class SegNetWarp(SegNet):
         custom_objects.update({
             'Warp': Warp,
             'ResizeBilinear': ResizeBilinear,
-            'LinearCombination': LinearCombination
+            'LinearCombination': LinearCombination,
+            'StopGradient': StopGradient
         })
         return custom_objects
 
@@ -0,0 +1,137 @@
+import argparse
+import multiprocessing
+import os
+
+import cv2
+
+import config
+from generator import CamVidGenerator, CityscapesGenerator, GTAGenerator, PackedDataset
+
+_datagen = None
+_target_size = None
+
+
+def _load_image(key):
+    img = _datagen._load_img(os.path.join(_datagen.dataset_path, key))
+    return cv2.resize(img, _target_size[::-1])
+
+
+def _load_label(key):
+    seg_img = _datagen._load_img(os.path.join(_datagen.dataset_path, key), _datagen._label_imread_flags)
+    return cv2.resize(seg_img, _target_size[::-1], interpolation=cv2.INTER_NEAREST)
+
+
+def split_keys(datagen, splits):
+    """
+    :param BaseDataGenerator datagen: generator with loaded files
+    :param list splits:
+    :return tuple: unique image keys (including previous frames), unique label keys
+    """
+    image_keys = set()
+    label_keys = set()
+    for split in splits:
+        for img_paths, label_path in datagen._data[split]:
+            if isinstance(img_paths, str):
+                img_paths = [img_paths]
+
+            for img_path in img_paths:
+                image_keys.add(datagen._packed_key(img_path))
+            label_keys.add(datagen._packed_key(label_path))
+
+    # sorted keys keep frames of the same city/sequence together in the file
+    return sorted(image_keys), sorted(label_keys)
+
+
+if __name__ == '__main__':
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Pack resized frames and labels into memory-mapped dataset')
+
+        parser.add_argument(
+            '-d', '--dataset',
+            help='Dataset [city, camvid, gta]',
+            default='city'
+        )
+
+        parser.add_argument(
+            '-o', '--output',
+            help='Output directory',
+            required=True
+        )
+
+        parser.add_argument(
+            '--splits',
+            help='Comma separated splits',
+            default='train,val'
+        )
+
+        parser.add_argument(
+            '--prev',
+            help='How many previous frames to pack (Cityscapes, 1 for flow models)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--prev_skip',
+            help='Skipped frames before current frame (Cityscapes)',
+            default=0
+        )
+
+        parser.add_argument(
+            '-p', '--processes',
+            help='Number of processes used for decoding',
+            default=multiprocessing.cpu_count()
+        )
+
+        parser.add_argument(
+            '--height',
+            help='Target image height',
+            default=config.target_size()[0]
+        )
+
+        parser.add_argument(
+            '--width',
+            help='Target image width',
+            default=config.target_size()[1]
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+
+    dataset_path = config.data_path()
+    _target_size = int(args.height), int(args.width)
+
+    if args.dataset == 'city':
+        _datagen = CityscapesGenerator(dataset_path, how_many_prev=int(args.prev), prev_skip=int(args.prev_skip))
+    elif args.dataset == 'camvid':
+        _datagen = CamVidGenerator(dataset_path)
+    elif args.dataset == 'gta':
+        _datagen = GTAGenerator(dataset_path)
+    else:
+        raise Exception("Unknown dataset %s!" % args.dataset)
+
+    _datagen.load_files()
+
+    image_keys, label_keys = split_keys(_datagen, args.splits.split(','))
+    print("-- packing %d images and %d labels of size %s to %s" % (len(image_keys), len(label_keys), _target_size, args.output))
+
+    # workers are forked with generator and target size already set
+    pool = multiprocessing.Pool(int(args.processes))
+    try:
+        PackedDataset.pack(
+            args.output,
+            _target_size,
+            image_keys,
+            label_keys,
+            _load_image,
+            _load_label,
+            imap=lambda f, keys: pool.imap(f, keys, chunksize=8)
+        )
+        pool.close()
+    except KeyboardInterrupt:
+        print("Keyboard interrupted")
+        pool.terminate()
+    finally:
+        pool.join()
@@ -0,0 +1,173 @@
+import argparse
+
+import numpy as np
+
+import config
+from generator import CityscapesFlowGenerator, FeatureCache
+from models import ICNet, ICNetWarp, SegNet, SegNetWarp
+
+
+def create_feature_model(model_name, target_size, n_classes, weights, input_dtype='float32'):
+    """
+    Trained base model with outputs of layers whose features are warped by warp variants
+
+    :param str model_name: icnet | segnet
+    :param tuple target_size: (height, width)
+    :param int n_classes:
+    :param str weights: weights of trained base model
+    :param str input_dtype: type of frames fed to the model (as in training of warp model)
+    :return tuple: (keras model, feature names)
+    """
+    from keras.models import Model
+
+    if model_name == 'icnet':
+        model = ICNet(target_size, n_classes, for_training=False, input_dtype=input_dtype)
+        names = ICNetWarp.WARP_FEATURES
+    elif model_name == 'segnet':
+        model = SegNet(target_size, n_classes, for_training=False, input_dtype=input_dtype)
+        names = SegNetWarp.WARP_FEATURES
+    else:
+        raise Exception("Unknown model %s!" % model_name)
+
+    model.load_for_inference(weights)
+
+    # sub-models (branches, blocks) are nodes of the base model, take their last output
+    outputs = [model.k.get_layer(name).get_output_at(-1) for name in names]
+    return Model(model.k.input, outputs), names
+
+
+def previous_frames(datagen, splits):
+    """
+    :param BaseFlowGenerator datagen: generator with loaded files
+    :param list splits:
+    :return list: unique paths of previous frames of all flow pairs
+    """
+    paths = set()
+    for split in splits:
+        for img_old_path, _ in datagen.flow_pairs(split):
+            paths.add(img_old_path)
+
+    return sorted(paths)
+
+
+def feature_batches(feature_model, datagen, paths, target_size, batch_size):
+    """
+    :return: generator of lists of float16 feature batches
+    """
+    for i in range(0, len(paths), batch_size):
+        frames = [
+            datagen.normalize(datagen._load_resized_img(path, target_size), target_size=None)
+            for path in paths[i:i + batch_size]
+        ]
+
+        features = feature_model.predict(np.array(frames), len(frames), 0)
+        if not isinstance(features, list):
+            features = [features]
+
+        yield [feature.astype(np.float16) for feature in features]
+
+
+if __name__ == '__main__':
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Precompute features of previous frames by trained base model')
+
+        parser.add_argument(
+            '-m', '--model',
+            help='Base model [icnet, segnet]',
+            default='icnet'
+        )
+
+        parser.add_argument(
+            '-w', '--weights',
+            help='Weights of trained base model',
+            required=True
+        )
+
+        parser.add_argument(
+            '-o', '--output',
+            help='Output directory',
+            required=True
+        )
+
+        parser.add_argument(
+            '--splits',
+            help='Comma separated splits',
+            default='train,val'
+        )
+
+        parser.add_argument(
+            '--prev_skip',
+            help='Skipped frames before current frame (as in training)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--norm',
+            help='Normalization of frames, the same as in training of warp model [minmax, fixed]',
+            default='minmax'
+        )
+
+        parser.add_argument(
+            '--dtype',
+            help='Type of frames fed to the model, the same as in training of warp model [float32, float16]',
+            default='float32'
+        )
+
+        parser.add_argument(
+            '-b', '--batch',
+            help='Batch size',
+            default=8
+        )
+
+        parser.add_argument(
+            '--gid',
+            help='GPU id',
+            default=None
+        )
+
+        parser.add_argument(
+            '--height',
+            help='Target image height',
+            default=config.target_size()[0]
+        )
+
+        parser.add_argument(
+            '--width',
+            help='Target image width',
+            default=config.target_size()[1]
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+
+    if args.gid is not None:
+        import os
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gid
+
+    dataset_path = config.data_path()
+    target_size = int(args.height), int(args.width)
+
+    datagen = CityscapesFlowGenerator(dataset_path, prev_skip=int(args.prev_skip))
+    datagen.set_normalization(args.norm)
+    datagen.set_input_dtype(args.dtype)
+    datagen.load_files()
+
+    feature_model, names = create_feature_model(args.model, target_size, datagen.n_classes, args.weights, args.dtype)
+
+    paths = previous_frames(datagen, args.splits.split(','))
+    keys = [datagen._packed_key(path) for path in paths]
+    print("-- computing features %s of %d frames (%s, %s) to %s" % (
+        ', '.join(names), len(keys), args.norm, args.dtype, args.output))
+
+    FeatureCache.pack(
+        args.output,
+        target_size,
+        keys,
+        names,
+        feature_batches(feature_model, datagen, paths, target_size, int(args.batch)),
+        normalization=args.norm,
+        input_dtype=args.dtype
+    )
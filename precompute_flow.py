@@ -0,0 +1,167 @@
+import argparse
+import multiprocessing
+import time
+
+import config
+from generator import CamVidFlowGenerator, CityscapesFlowGenerator, FlowCache
+
+_datagen = None
+
+
+def create_generator(dataset, dataset_path, optical_flow_type, flow_cache, debug_samples=0):
+    """
+    :param str dataset: city | camvid
+    :param str dataset_path:
+    :param str optical_flow_type: farn | dis | deepflow
+    :param FlowCache flow_cache:
+    :param int debug_samples:
+    :rtype: generator.BaseFlowGenerator
+    """
+    if dataset == 'city':
+        return CityscapesFlowGenerator(dataset_path, debug_samples=debug_samples, optical_flow_type=optical_flow_type, flow_cache=flow_cache)
+    elif dataset == 'camvid':
+        return CamVidFlowGenerator(dataset_path, debug_samples=debug_samples, optical_flow_type=optical_flow_type, flow_cache=flow_cache)
+    else:
+        raise Exception("Unknown dataset %s!" % dataset)
+
+
+def _init_worker(dataset, dataset_path, optical_flow_type, cache_dir, cache_storage):
+    # every process has its own generator (optical flow objects from cv2 can't be shared)
+    global _datagen
+    flow_cache = FlowCache(cache_dir, storage=cache_storage)
+    _datagen = create_generator(dataset, dataset_path, optical_flow_type, flow_cache)
+
+
+def _precompute(job):
+    img_old_path, img_new_path, target_size = job
+    return _datagen.precompute_optical_flow(img_old_path, img_new_path, target_size)
+
+
+def precompute(dataset, dataset_path, datagen, splits, target_size, processes):
+    """
+    Calculates optical flow of all pairs in splits into flow cache on all processes.
+    Already cached pairs are skipped, so it may be restarted after interruption.
+    Flow of augmented (flipped, rotated, zoomed) frames is derived from this flow in training.
+
+    :param str dataset: city | camvid
+    :param str dataset_path: root of datasets (as for create_generator)
+    :param BaseFlowGenerator datagen: generator with loaded files and flow cache
+    :param list splits: e.g. ['train', 'val']
+    :param tuple target_size: (height, width)
+    :param int processes:
+    """
+    jobs = []
+    for split in splits:
+        for img_old_path, img_new_path in datagen.flow_pairs(split):
+            jobs.append((img_old_path, img_new_path, target_size))
+
+    print("-- precomputing %d flows on %d processes" % (len(jobs), processes))
+
+    pool = multiprocessing.Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(dataset, dataset_path, datagen.optical_flow_type, datagen.flow_cache.cache_dir, datagen.flow_cache.storage)
+    )
+
+    calculated = 0
+    skipped = 0
+    start = time.time()
+    try:
+        for i, was_calculated in enumerate(pool.imap_unordered(_precompute, jobs, chunksize=4)):
+            if was_calculated:
+                calculated += 1
+            else:
+                skipped += 1
+
+            if (i + 1) % 100 == 0 or i + 1 == len(jobs):
+                elapsed = time.time() - start
+                print("-- %d/%d flows (calculated %d, cached %d) %.2f flows/s" % (
+                    i + 1, len(jobs), calculated, skipped, calculated / max(elapsed, 1e-6)))
+
+        pool.close()
+    except KeyboardInterrupt:
+        print("-- Keyboard interrupted, run again to resume")
+        pool.terminate()
+    finally:
+        pool.join()
+
+    elapsed = time.time() - start
+    print("-- finished in %.1f s: calculated %d, already cached %d, %.2f flows/s" % (
+        elapsed, calculated, skipped, calculated / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Precompute optical flow into flow cache')
+
+        parser.add_argument(
+            '-d', '--dataset',
+            help='Dataset [city, camvid]',
+            default='city'
+        )
+
+        parser.add_argument(
+            '-o', '--optic',
+            help='Optical flow',
+            default='farn'
+        )
+
+        parser.add_argument(
+            '--flow_cache',
+            help='Directory of optical flow cache',
+            default=config.flow_cache_path()
+        )
+
+        parser.add_argument(
+            '--flow_cache_storage',
+            help='Storage of cached optical flow [float32, float16, quantized]',
+            default='float16'
+        )
+
+        parser.add_argument(
+            '--splits',
+            help='Comma separated splits',
+            default='train,val'
+        )
+
+        parser.add_argument(
+            '-p', '--processes',
+            help='Number of processes',
+            default=multiprocessing.cpu_count()
+        )
+
+        parser.add_argument(
+            '--debug',
+            help='Just debug (number to pick from dataset)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--height',
+            help='Target image height',
+            default=config.target_size()[0]
+        )
+
+        parser.add_argument(
+            '--width',
+            help='Target image width',
+            default=config.target_size()[1]
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+
+    if args.flow_cache is None:
+        raise Exception("Flow cache directory must be set (--flow_cache or $FLOW_CACHE)")
+
+    dataset_path = config.data_path()
+    target_size = int(args.height), int(args.width)
+
+    flow_cache = FlowCache(args.flow_cache, storage=args.flow_cache_storage)
+    datagen = create_generator(args.dataset, dataset_path, args.optic, flow_cache, debug_samples=int(args.debug))
+    datagen.load_files()
+
+    precompute(args.dataset, dataset_path, datagen, args.splits.split(','), target_size, int(args.processes))
@@ -105,6 +105,18 @@ if __name__ == '__main__':
             default=False
         )
 
+        parser.add_argument(
+            '--rotation',
+            help='Sigma of random rotation of train samples in degrees (0 disables it)',
+            default=5.0
+        )
+
+        parser.add_argument(
+            '--zoom',
+            help='Sigma of random zoom of train samples (0 disables it)',
+            default=0.1
+        )
+
         parser.add_argument(
             '--workers',
             help='Workers',
@@ -122,6 +134,106 @@ if __name__ == '__main__':
             default=50
         )
 
+        parser.add_argument(
+            '--sparse',
+            action='store_true',
+            help='Sparse labels (class index maps instead of one-hot)',
+            default=False
+        )
+
+        parser.add_argument(
+            '--flow_cache',
+            help='Directory of optical flow cache (disabled if not set)',
+            default=config.flow_cache_path()
+        )
+
+        parser.add_argument(
+            '--flow_cache_storage',
+            help='Storage of cached optical flow [float32, float16, quantized]',
+            default='float16'
+        )
+
+        parser.add_argument(
+            '--flow_cache_size',
+            help='Size limit of optical flow cache in MB',
+            default=None
+        )
+
+        parser.add_argument(
+            '--shuffle_block',
+            help='Number of neighbouring samples (same city/sequence) shuffled together, 1 for full shuffle',
+            default=64
+        )
+
+        parser.add_argument(
+            '--frame_cache_size',
+            help='Size limit of in-memory cache of decoded frames in MB',
+            default=None
+        )
+
+        parser.add_argument(
+            '--scratch',
+            help='Local directory where dataset files are staged ahead of use',
+            default=os.environ.get('SCRATCH')
+        )
+
+        parser.add_argument(
+            '--scratch_size',
+            help='Size limit of staged files in MB',
+            default=None
+        )
+
+        parser.add_argument(
+            '--packed',
+            help='Directory of packed dataset (see pack_dataset.py)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--old_frame',
+            help='Previous frame in training of warp models [shared, frozen, input]',
+            default='shared'
+        )
+
+        parser.add_argument(
+            '--features',
+            help='Directory of feature cache for old frame mode input (see precompute_features.py)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--init_weights',
+            help='Initial weights loaded by layer names (e.g. trained ICNet for ICNetWarp)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--eval_miou',
+            action='store_true',
+            help='Evaluates exact mIoU (confusion matrix over validation split) after every epoch, '
+                 'costs a second pass over validation split, scores first output of training graph '
+                 '(ICNet at 1/4 resolution, see evaluate.py for full resolution)',
+            default=False
+        )
+
+        parser.add_argument(
+            '--norm',
+            help='Normalization of frames [minmax, fixed]',
+            default='minmax'
+        )
+
+        parser.add_argument(
+            '--dtype',
+            help='Type of frames and flow fed to the model [float32, float16]',
+            default='float32'
+        )
+
+        parser.add_argument(
+            '--warp_method',
+            help='Implementation of warping in warp models [gather_nd, gather, resampler]',
+            default='gather'
+        )
+
         parser.add_argument(
             '--gpu_percent',
             help='How much GPU memory will be taken',
@@ -155,6 +267,20 @@ if __name__ == '__main__':
     print("run name", args.name)
     print("---------------")
     print("data augmentation", args.aug)
+    print("rotation", args.rotation, "zoom", args.zoom)
+    print("sparse labels", args.sparse)
+    print("flow cache", args.flow_cache)
+    print("packed dataset", args.packed)
+    print("shuffle block", args.shuffle_block)
+    print("frame cache size", args.frame_cache_size)
+    print("scratch", args.scratch, "size", args.scratch_size)
+    print("old frame", args.old_frame)
+    print("features", args.features)
+    print("eval mIoU", args.eval_miou)
+    print("init weights", args.init_weights)
+    print("normalization", args.norm)
+    print("input dtype", args.dtype)
+    print("warp method", args.warp_method)
     print("---------------")
     print("workers", args.workers, "multiprocess", multiprocess)
     print("max_queue", args.queue)
@@ -208,7 +334,25 @@ if __name__ == '__main__':
             debug_samples=debug_samples,
             early_stopping=early_stopping,
             optical_flow_type=optical_flow_type,
-            data_augmentation=data_augmentation
+            data_augmentation=data_augmentation,
+            sparse_labels=args.sparse,
+            flow_cache_dir=args.flow_cache,
+            flow_cache_storage=args.flow_cache_storage,
+            flow_cache_size=int(args.flow_cache_size) * 1024 * 1024 if args.flow_cache_size is not None else None,
+            packed_path=args.packed,
+            old_frame=args.old_frame,
+            init_weights=args.init_weights,
+            features_path=args.features,
+            eval_miou=args.eval_miou,
+            normalization=args.norm,
+            input_dtype=args.dtype,
+            frame_cache_size=int(args.frame_cache_size) * 1024 * 1024 if args.frame_cache_size is not None else None,
+            scratch_dir=args.scratch,
+            scratch_size=int(args.scratch_size) * 1024 * 1024 if args.scratch_size is not None else None,
+            shuffle_block=int(args.shuffle_block),
+            warp_method=args.warp_method,
+            rotation=float(args.rotation),
+            zoom=float(args.zoom)
         )
 
         trainer.model.compile(
@@ -4,11 +4,12 @@ np.random.seed(2018)
 
 import json
 
-from keras.callbacks import ModelCheckpoint, LambdaCallback
+from keras.callbacks import ModelCheckpoint
 
 import config
 import utils
-from callbacks import SaveLastTrainedEpochCallback, CustomTensorBoard
+from callbacks import SaveLastTrainedEpochCallback, CustomTensorBoard, ConfusionMatrixCallback
+from factory import create_generator, create_model
 from generator import *
 from models import *
 import importlib
@@ -19,7 +20,7 @@ import re
 class Trainer:
     train_callbacks = []
 
-    def __init__(self, model_name, dataset_path, target_size, batch_size, n_gpu, debug_samples=0, early_stopping=10, optical_flow_type='farn', data_augmentation=True):
+    def __init__(self, model_name, dataset_path, target_size, batch_size, n_gpu, debug_samples=0, early_stopping=10, optical_flow_type='farn', data_augmentation=True, sparse_labels=False, flow_cache_dir=None, flow_cache_storage='float16', flow_cache_size=None, packed_path=None, old_frame='shared', init_weights=None, features_path=None, eval_miou=False, normalization='minmax', input_dtype='float32', frame_cache_size=None, scratch_dir=None, scratch_size=None, shuffle_block=64, warp_method='gather', rotation=5.0, zoom=0.1):
         is_debug = debug_samples > 0
 
         self.debug_samples = debug_samples
@@ -29,64 +30,45 @@ class Trainer:
         self.target_size = target_size
         self._early_stopping = early_stopping
         self._optical_flow_type = optical_flow_type
+        self._eval_miou = eval_miou
+        self._shuffle_block = shuffle_block
         print("-- Number of GPUs used %d" % self.n_gpu)
         print("-- Batch size (on all GPUs) %d" % self.batch_size)
+        print("-- Sparse labels %s" % sparse_labels)
 
-        prev_skip = 0
+        flow_cache = None
+        if flow_cache_dir is not None:
+            flow_cache = FlowCache(flow_cache_dir, storage=flow_cache_storage, max_size=flow_cache_size)
 
         # -------------  pick the right model with proper generator
-        # -------------------------------------------------------- SEGNET
-        if model_name == 'segnet':
-            self.datagen = CityscapesGenerator(dataset_path, debug_samples=debug_samples)
-            model = SegNet(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-        elif 'segnet_warp' in model_name:
-            self.datagen = CityscapesFlowGenerator(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type)
-
-            if model_name == 'segnet_warp0':
-                model = SegnetWarp0(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp1':
-                model = SegnetWarp1(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp2':
-                model = SegnetWarp2(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp3':
-                model = SegnetWarp3(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp01':
-                model = SegnetWarp01(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp12':
-                model = SegnetWarp12(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp23':
-                model = SegnetWarp23(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp012':
-                model = SegnetWarp012(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp123':
-                model = SegnetWarp123(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'segnet_warp0123':
-                model = SegnetWarp0123(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-        # -------------------------------------------------------- ICNET
-        elif model_name == 'icnet':
-            self.datagen = CityscapesGeneratorForICNet(dataset_path, debug_samples=debug_samples)
-            model = ICNet(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-        elif 'icnet_warp' in model_name:
-            self.datagen = CityscapesFlowGeneratorForICNet(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type)
-
-            if model_name == 'icnet_warp0':
-                model = ICNetWarp0(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'icnet_warp1':
-                model = ICNetWarp1(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'icnet_warp2':
-                model = ICNetWarp2(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'icnet_warp01':
-                model = ICNetWarp01(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'icnet_warp12':
-                model = ICNetWarp12(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-            elif model_name == 'icnet_warp012':
-                model = ICNetWarp012(target_size, self.datagen.n_classes, debug_samples=debug_samples)
-        else:
-            raise Exception("Unknown model!")
-            model = None
+        self.datagen = create_generator(model_name, dataset_path, debug_samples, optical_flow_type, sparse_labels, flow_cache)
+        self.datagen.set_augmentation(rotation, zoom)
+        self.datagen.set_normalization(normalization)
+        self.datagen.set_input_dtype(input_dtype)
+        model = create_model(model_name, target_size, self.datagen.n_classes, debug_samples, sparse_labels, old_frame,
+                             input_dtype=input_dtype, warp_method=warp_method)
 
         print("-- Selected model", model.name)
 
+        if init_weights is not None:
+            # e.g. weights of base model (ICNet for ICNetWarp), matching layers are loaded
+            print("-- Initial weights %s" % init_weights)
+            model.k.load_weights(init_weights, by_name=True)
+
+        if packed_path is not None:
+            self.datagen.load_packed(packed_path)
+
+        if frame_cache_size is not None:
+            self.datagen.use_frame_cache(frame_cache_size)
+
+        if scratch_dir is not None:
+            self.datagen.use_staging(scratch_dir, scratch_size)
+
+        if old_frame == 'input':
+            if features_path is None:
+                raise Exception("Features of previous frames must be set for old frame mode 'input'")
+            self.datagen.load_features(features_path, model.prev_feature_names(), target_size)
+
         # -------------  set multi gpu model
         self.model = model
         self.cpu_model = None
@@ -199,7 +181,49 @@ class Trainer:
 
         return restart_epoch, restart_run_name, batch_size
 
-    def prepare_callbacks(self, run_name, epochs, use_validation_data=False):
+    def prepare_callbacks(self, run_name, epochs, use_validation_data=False, batch_size=None):
+        # ------------- exact mIoU on validation data (before callbacks using logs)
+        # own sequence, the one of fit_generator is being prefetched by its enqueuer meanwhile,
+        # every sample once (smaller last batch), first output of training graph at its label resolution
+        if self._eval_miou:
+            eval_sequence = self.datagen.sequence('val', batch_size or self.batch_size, self.target_size, shuffle=False,
+                                                  partial=True)
+            self.train_callbacks.append(ConfusionMatrixCallback(
+                eval_sequence,
+                self.datagen.n_classes,
+                self.datagen.ignored_classes,
+                self.datagen.class_names
+            ))
+
+        # ------------- hit rate of frame cache (of the main process, multiprocessing workers have their own caches)
+        if self.datagen.frame_cache is not None:
+            frame_cache = self.datagen.frame_cache
+
+            def print_frame_cache(epoch, logs):
+                print(frame_cache.summary())
+
+            self.train_callbacks.append(keras.callbacks.LambdaCallback(on_epoch_end=print_frame_cache))
+
+        # ------------- progress of training for staging (loaders may run in other processes)
+        # position is keyed by epoch of the train sequence (counted from 0 in every fit), late batches of previous
+        # epoch are still trained when the sequence has already scheduled the next one
+        if self.datagen.stager is not None:
+            stager = self.datagen.stager
+            staging_batch_size = batch_size or self.batch_size
+            progress = {'epoch': 0}
+
+            def advance_staging(batch, logs):
+                stager.advance('train', (batch + 1) * staging_batch_size, progress['epoch'])
+
+            def print_staging(epoch, logs):
+                progress['epoch'] += 1
+                print(stager.summary())
+
+            self.train_callbacks.append(keras.callbacks.LambdaCallback(
+                on_batch_end=advance_staging,
+                on_epoch_end=print_staging
+            ))
+
         # ------------- tensorboard
         tb = CustomTensorBoard(
             (self.cpu_model if self.n_gpu > 1 else self.model.k),
@@ -257,15 +281,14 @@ class Trainer:
 
         self.datagen.load_files()
 
-        train_generator = self.datagen.flow('train', batch_size, self.target_size)
-        train_steps = self.datagen.steps_per_epoch('train', batch_size)
-        val_generator = self.datagen.flow('val', batch_size, self.target_size)
-        val_steps = self.datagen.steps_per_epoch('val', batch_size)
-
-        if not self.is_debug:
-            # -- shuffle dataset after every epoch
-            shuffler = LambdaCallback(on_epoch_end=lambda epoch, logs: self.datagen.shuffle('train'))
-            self.train_callbacks.append(shuffler)
+        # indexed datasets (block-shuffled after every epoch, see EpochSampler), batches are built in parallel by workers
+        # into reused buffers, ring is larger than number of batches kept by enqueuer (one enqueuer per sequence)
+        buffers = BatchRing.enqueuer_size(max_queue, workers)
+        train_generator = self.datagen.sequence('train', batch_size, self.target_size, shuffle=not self.is_debug, buffers=buffers,
+                                                block_size=self._shuffle_block)
+        train_steps = len(train_generator)
+        val_generator = self.datagen.sequence('val', batch_size, self.target_size, shuffle=False, buffers=buffers)
+        val_steps = len(val_generator)
 
         # ------------- losswise dashboard
 
@@ -291,22 +314,30 @@ class Trainer:
             self._optical_flow_type
         )
 
-        self.prepare_callbacks(run_name, epochs)
+        self.prepare_callbacks(run_name, epochs, batch_size=batch_size)
 
-        self.model.k.fit_generator(
-            generator=train_generator,
-            steps_per_epoch=train_steps,
-            epochs=epochs,
-            initial_epoch=restart_epoch,
-            verbose=1,
-            validation_data=val_generator,
-            validation_steps=val_steps,
-            callbacks=self.train_callbacks,
-            max_queue_size=max_queue,
-            shuffle=not self.is_debug,
-            use_multiprocessing=multiprocess,
-            workers=workers
-        )
+        train_generator.attach_enqueuer(max_queue, workers)
+        val_generator.attach_enqueuer(max_queue, workers)
+
+        try:
+            self.model.k.fit_generator(
+                generator=train_generator,
+                steps_per_epoch=train_steps,
+                epochs=epochs,
+                initial_epoch=restart_epoch,
+                verbose=1,
+                validation_data=val_generator,
+                validation_steps=val_steps,
+                callbacks=self.train_callbacks,
+                max_queue_size=max_queue,
+                # samples are shuffled by the sequence, batches are loaded in order (staged ahead)
+                shuffle=False,
+                use_multiprocessing=multiprocess,
+                workers=workers
+            )
+        finally:
+            if self.datagen.stager is not None:
+                self.datagen.stager.close()
 
         # save final model
         self.model.save_final(self.get_run_path(run_name, '../../weights/'), epochs)
@@ -20,14 +20,15 @@ def mkdir_recursive(path):
 
 def class_image_to_image(class_id_image, class_id_to_rgb_map):
     """Map the class image to a rgb-color image."""
-    colored_image = np.zeros((class_id_image.shape[0], class_id_image.shape[1], 3), np.uint8)
-    for i in range(-1, 256):
-        try:
-            cl = class_id_to_rgb_map[i]
-            colored_image[class_id_image[:, :] == i] = cl.color
-        except KeyError as key_error:
-            pass
-    return colored_image
+    # lookup table for ids -1..255 (shifted by one), last entry stays black for ids out of range
+    lut = np.zeros((258, 3), np.uint8)
+    for i, cl in class_id_to_rgb_map.items():
+        if -1 <= i <= 255:
+            lut[i + 1] = cl.color
+
+    lut_index = class_id_image.astype(np.int32) + 1
+    lut_index[(lut_index < 0) | (lut_index > 256)] = len(lut) - 1
+    return lut[lut_index]
 
 
 def class_image_to_image_slow(class_id_image, class_id_to_rgb_map):
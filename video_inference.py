@@ -1,15 +1,268 @@
 import argparse
 import os
+import threading
+import time
 
 import cv2
 import numpy as np
+from keras.layers import Input
+from keras.models import Model
 
 import config
 from generator import CityscapesFlowGenerator
 from models import *
+from models.layers.warp import ResizeBilinear, Warp
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ReadAhead(threading.Thread):
+    """
+    Iterates given iterable in background thread into bounded queue (pipeline stage)
+    """
+    _end = object()
+
+    def __init__(self, iterable, queue_size=32):
+        super(ReadAhead, self).__init__()
+        self.daemon = True
+        self._iterable = iterable
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            for item in self._iterable:
+                self._queue.put(item)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(self._end)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._end:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+
+
+class FrameWriter(threading.Thread):
+    """
+    Encodes predictions to frames and writes them to video (in background thread if queue_size is set)
+    """
+
+    def __init__(self, video_writer, encode, queue_size=None):
+        """
+        :param cv2.VideoWriter video_writer:
+        :param encode: function prediction -> BGR frame
+        :param int queue_size: None for writing synchronously
+        """
+        super(FrameWriter, self).__init__()
+        self.daemon = True
+        self._video_writer = video_writer
+        self._encode = encode
+        self._queue = None
+        self._error = None
+        if queue_size is not None:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self.start()
+
+    def write(self, prediction):
+        if self._queue is not None:
+            # writer thread failed, nothing consumes the queue anymore
+            if self._error is not None:
+                raise self._error
+            self._queue.put(prediction)
+        else:
+            self._video_writer.write(self._encode(prediction))
+
+    def run(self):
+        while True:
+            prediction = self._queue.get()
+            if prediction is None:
+                break
+
+            if self._error is not None:
+                # only drained, so that producer blocked on full queue can notice the error
+                continue
+
+            try:
+                self._video_writer.write(self._encode(prediction))
+            except Exception as e:
+                self._error = e
+
+    def release(self):
+        if self._queue is not None:
+            self._queue.put(None)
+            self.join()
+        self._video_writer.release()
+
+        if self._error is not None:
+            raise self._error
+
+
+class KeyFrameScheduler:
+    """
+    Decides which frames are processed by the full network (key frames).
+    Other frames only propagate outputs of the last key frame by optical flow.
+
+    Key frames are either fixed (every `interval`-th frame) or adaptive: frame is key frame when mean magnitude
+    of optical flow from the last key frame exceeds `flow_threshold`, interval is then only the largest gap.
+    """
+
+    def __init__(self, interval=None, flow_threshold=None):
+        """
+        :param int interval: every `interval`-th frame is key frame (None or 1 - every frame),
+            with flow threshold the largest gap between key frames (None - unbounded)
+        :param float flow_threshold: mean magnitude of optical flow from the last key frame (in pixels)
+            which makes a key frame, None for fixed interval
+        """
+        self.interval = interval
+        self.flow_threshold = flow_threshold
+        self.reset()
+
+    @property
+    def enabled(self):
+        return (self.interval or 1) > 1 or self.flow_threshold is not None
+
+    @property
+    def adaptive(self):
+        """
+        :return bool: decision needs optical flow from the last key frame
+        """
+        return self.flow_threshold is not None
+
+    def reset(self):
+        self._since_key = None
+        self.key_frames = 0
+        self.frames = 0
+
+    def is_key(self, key_flow=None):
+        """
+        :param key_flow: optical flow from the last key frame to current frame (required when adaptive)
+        :rtype: bool
+        """
+        if self._since_key is None:
+            is_key = True
+        elif not self.adaptive:
+            is_key = self._since_key + 1 >= (self.interval or 1)
+        elif self.interval is not None and self._since_key + 1 >= self.interval:
+            is_key = True
+        else:
+            magnitude = np.mean(np.sqrt(np.sum(np.square(key_flow), axis=-1)))
+            is_key = magnitude > self.flow_threshold
+
+        self._since_key = 0 if is_key else self._since_key + 1
+        self.frames += 1
+        self.key_frames += int(is_key)
+        return is_key
+
+
+class ModelStream:
+    """
+    One registered model processing one video stream, keeps state between frames
+    (previous frame and features, key frame) and writes colored predictions to its output
+    """
+
+    def __init__(self, model, warp, writer, scheduler=None, propagation=None):
+        """
+        :param BaseModel model: model loaded for inference
+        :param bool warp: model takes previous frame, optical flow and previous features
+        :param FrameWriter writer:
+        :param KeyFrameScheduler scheduler: key frames of warp model (None for every frame)
+        :param propagation: keras model propagating key frame outputs (see VideoEvaluator.propagation_model)
+        """
+        self.model = model
+        self.warp = warp
+        self.writer = writer
+        self.scheduler = scheduler
+        self.propagation = propagation
+
+        self.frames_count = 0
+        self.elapsed = 0.
+
+        self._last_frame = None
+        self._last_frame_norm = None
+        self._last_prediction = None
+        self._key_frame = None
+        self._key_frame_norm = None
+        self._key_predictions = None
+
+    def process(self, evaluator, datagen, batch):
+        """
+        :param VideoEvaluator evaluator:
+        :param BaseFlowGenerator datagen:
+        :param list batch: list of (frame_i, frame, normalized frame)
+        """
+        start = time.time()
+
+        if self.warp:
+            for _, frame, frame_norm in batch:
+                self._process_warp(evaluator, datagen, frame, frame_norm)
+        else:
+            input = np.array([frame_norm for _, _, frame_norm in batch])
+            for prediction in self.model.k.predict(input, len(batch), 0):
+                self.writer.write(prediction)
+
+        self.frames_count += len(batch)
+        self.elapsed += time.time() - start
+
+    def _process_warp(self, evaluator, datagen, frame, frame_norm):
+        if self._last_frame is None:
+            self._last_frame = frame
+            self._last_frame_norm = frame_norm
+
+        key_flow = None
+        if self._key_frame is not None and self.scheduler.adaptive:
+            key_flow = datagen.calc_optical_flow(frame, self._key_frame)
+
+        if self.scheduler.is_key(key_flow):
+            # flow from the previous frame is already computed when the previous frame is the key frame
+            flow = key_flow if key_flow is not None and self._key_frame is self._last_frame else None
+            if flow is None:
+                flow = datagen.calc_optical_flow(frame, self._last_frame)
+
+            predictions = evaluator.process_frame_warping(
+                frame, self._last_frame, self.model, self._last_prediction,
+                verbose=0,
+                frame_norm=frame_norm,
+                last_frame_norm=self._last_frame_norm,
+                flow=flow
+            )
+            self._key_frame = frame
+            self._key_frame_norm = frame_norm
+            self._key_predictions = predictions
+        else:
+            if key_flow is None:
+                key_flow = datagen.calc_optical_flow(frame, self._key_frame)
+
+            input = [np.array([self._key_frame_norm]), np.array([frame_norm]), np.array([key_flow], dtype=datagen.input_dtype)]
+            predictions = self.propagation.predict(input + self._key_predictions, 1, 0)
+
+        self.writer.write(predictions[0][0])
+
+        self._last_frame = frame
+        self._last_frame_norm = frame_norm
+        self._last_prediction = predictions
+
+    def print_stats(self):
+        if self.warp and self.scheduler.enabled:
+            print("-- %s key frames %d/%d" % (self.model.name, self.scheduler.key_frames, self.scheduler.frames))
+
+        print("-- %s processed %d frames, %.2f fps" % (
+            self.model.name, self.frames_count, self.frames_count / max(self.elapsed, 1e-6)))
 
 
 class VideoEvaluator:
+    def __init__(self):
+        self._models = []
+
     @staticmethod
     def get_gpu_name():
         from tensorflow.python.client import device_lib
@@ -63,10 +316,6 @@ class VideoEvaluator:
         fourcc = cv2.VideoWriter_fourcc(*'X264')
         return cv2.VideoWriter(output_file, fourcc, float(fps), (model.target_size[1], model.target_size[0]))
 
-    _last_frame = None
-    _last_prediction = None
-    _models = []
-
     def process_frame(self, frame, model, verbose=1):
         """
 
@@ -75,30 +324,36 @@ class VideoEvaluator:
         :return list: should be a list with the prediction (because of compatibility with warping prediciton)
         """
 
-        frame = cv2.resize(frame, config.target_size()[::-1])
         frame_norm = datagen.normalize(frame, config.target_size())
 
         input = [np.array([frame_norm])]
         return [model.k.predict(input, 1, verbose)]
 
-    def process_frame_warping(self, frame, last_frame, model, last_prediction=None, verbose=1):
+    def process_frame_warping(self, frame, last_frame, model, last_prediction=None, verbose=1, frame_norm=None, last_frame_norm=None,
+                              flow=None):
         """
 
         :param frame:
         :param last_frame:
         :param BaseModel model:
         :param verbose:
+        :param frame_norm: already normalized frame (optional)
+        :param last_frame_norm: already normalized last frame (optional)
+        :param flow: already calculated optical flow (optional)
         :return:
         """
 
-        flow = datagen.calc_optical_flow(frame, last_frame)
-        frame_norm = datagen.normalize(frame, config.target_size())
-        last_frame_norm = datagen.normalize(last_frame, config.target_size())
+        if flow is None:
+            flow = datagen.calc_optical_flow(frame, last_frame)
+        if frame_norm is None:
+            frame_norm = datagen.normalize(frame, config.target_size())
+        if last_frame_norm is None:
+            last_frame_norm = datagen.normalize(last_frame, config.target_size())
 
         input_with_flow = [
             np.array([last_frame_norm]),
             np.array([frame_norm]),
-            np.array([flow])
+            np.array([flow], dtype=datagen.input_dtype)
         ]
 
         if last_prediction is not None:
@@ -110,71 +365,167 @@ class VideoEvaluator:
         all_predictions = model.k.predict(input_with_flow, 1, verbose)
         return all_predictions
 
-    def process_video(self, datagen, input_file, skip_from_start=0, until_frame=None):
-        # may process more models
-        for model_params in self._models:
-            # load input video
-            vid, fps = self._open_video(input_file)
-            try:
-                # load model
-                model = model_params['model']
-                model.k.load_weights(model_params['weights'], by_name=True)
-                model.compile()
+    @staticmethod
+    def propagation_model(model):
+        """
+        Cheap model for non-key frames: trained FlowCNN of the warp model transforms optical flow
+        which warps all outputs of the key frame (prediction and features passed to next frame)
 
-                print('-- predicting model %s' % model.name)
+        :param BaseModel model: warp model for inference
+        :return: keras model [key_frame, frame, flow] + key outputs -> warped outputs
+        """
+        input_shapes = model.k.input_shape
+        output_shapes = model.k.output_shape
 
-                # prepare output file for the model and input file
-                out = self._prepare_output(input_file, model, fps)
-                # reset old state
-                self._last_frame = None
-                self._last_prediction = None
-                frame_i = 0
-
-                while True:
-                    ret, frame = vid.read()
-                    if not ret:
-                        vid.release()
-                        print("-- Released Video Resource")
-                        break
-
-                    # skipping boring part of video
-                    if frame_i < skip_from_start:
-                        frame_i += 1
-                        continue
-
-                    # cut from end
-                    if until_frame is not None and frame_i > until_frame:
-                        print(" -- Finishing at frame %d" % until_frame)
-                        break
-
-                    frame = cv2.resize(frame, config.target_size()[::-1])
-
-                    if model_params['warp']:
-                        if self._last_frame is None:
-                            self._last_frame = frame
-
-                        predictions = self.process_frame_warping(frame, self._last_frame, model, self._last_prediction)
-                    else:
-                        predictions = self.process_frame(frame, model)
-
-                    colored_prediction = datagen.one_hot_to_bgr(predictions[0], config.target_size(), datagen.n_classes, datagen.labels)
-                    out.write(colored_prediction)
+        # frames and flow of the same type as inputs of the warp model
+        img_key_input, img_key = model.typed_input(input_shapes[0][1:], name='data_key')
+        img_new_input, img_new = model.typed_input(input_shapes[1][1:], name='data_new')
+        flo_input, flo = model.typed_input(input_shapes[2][1:], name='data_flow')
+        transformed_flow = model.k.get_layer('FlowCNN')([img_key, img_new, flo])
 
-                    print('-- processed frame %d' % frame_i)
-                    self._last_frame = frame
-                    self._last_prediction = predictions
-                    frame_i += 1
-                out.release()
-                vid.release()
+        key_outputs = []
+        warped = []
+        for i, output_shape in enumerate(output_shapes):
+            key_output = Input(output_shape[1:], name='key_output_%d' % i)
+            flow = transformed_flow
+            if tuple(output_shape[1:3]) != tuple(input_shapes[2][1:3]):
+                flow = ResizeBilinear(output_shape[1:3])(transformed_flow)
+
+            key_outputs.append(key_output)
+            warped.append(Warp()([key_output, flow]))
 
-                print("-- Finished input stream")
-            except KeyboardInterrupt:
-                # Release the Video Device
+        return Model([img_key_input, img_new_input, flo_input] + key_outputs, warped, name='Propagation_' + model.name)
+
+    def _read_frames(self, vid, skip_from_start=0, until_frame=None):
+        """
+        Decodes frames of the video resized to target size
+        :return: generator of (frame_i, frame)
+        """
+        frame_i = 0
+        while True:
+            ret, frame = vid.read()
+            if not ret:
                 vid.release()
-                # Message to be displayed after releasing the device
                 print("-- Released Video Resource")
+                break
+
+            # skipping boring part of video
+            if frame_i < skip_from_start:
+                frame_i += 1
+                continue
+
+            # cut from end
+            if until_frame is not None and frame_i > until_frame:
+                print(" -- Finishing at frame %d" % until_frame)
+                break
+
+            yield frame_i, cv2.resize(frame, config.target_size()[::-1])
+            frame_i += 1
+
+    @staticmethod
+    def _preprocess_frames(datagen, frames):
+        """
+        :return: generator of (frame_i, frame, normalized frame)
+        """
+        for frame_i, frame in frames:
+            yield frame_i, frame, datagen.normalize(frame, None)
+
+    @staticmethod
+    def _batches(items, batch_size):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def process_video(self, datagen, input_file, skip_from_start=0, until_frame=None, batch_size=1, pipelined=False, queue_size=32,
+                      key_interval=None, key_threshold=None):
+        """
+        Decodes the video once and feeds its frames to all registered models
+
+        :param BaseFlowGenerator datagen:
+        :param str input_file:
+        :param int skip_from_start:
+        :param int until_frame:
+        :param int batch_size: frames predicted at once (models without warping)
+        :param bool pipelined: decoding, preprocessing and writing run in background threads connected by queues
+        :param int queue_size: size of queues between pipeline stages
+        :param int key_interval: warp models run full network on every `key_interval`-th frame,
+            other frames are propagated from the key frame by optical flow (largest gap with key_threshold)
+        :param float key_threshold: adaptive key frames, key frame when mean flow magnitude from key frame
+            exceeds it (pixels)
+        """
+
+        def encode(prediction):
+            return datagen.one_hot_to_bgr(prediction, config.target_size(), datagen.n_classes, datagen.labels)
+
+        # load input video
+        vid, fps = self._open_video(input_file)
+        streams = []
+        try:
+            for model_params in self._models:
+                model = model_params['model']
+                scheduler = None
+                propagation = None
+                if model_params['warp']:
+                    scheduler = KeyFrameScheduler(key_interval, key_threshold)
+                    if scheduler.enabled:
+                        if 'propagation' not in model_params:
+                            model_params['propagation'] = self.propagation_model(model)
+                        propagation = model_params['propagation']
+
+                # prepare output file for the model and input file
+                writer = FrameWriter(self._prepare_output(input_file, model, fps), encode, queue_size if pipelined else None)
+                streams.append(ModelStream(model, model_params['warp'], writer, scheduler, propagation))
+
+            print('-- predicting models %s' % ', '.join(stream.model.name for stream in streams))
+
+            frames = self._read_frames(vid, skip_from_start, until_frame)
+            if pipelined:
+                frames = ReadAhead(frames, queue_size)
+            frames = self._preprocess_frames(datagen, frames)
+            if pipelined:
+                frames = ReadAhead(frames, queue_size)
+
+            for batch in self._batches(frames, batch_size):
+                for stream in streams:
+                    stream.process(self, datagen, batch)
+
+                for frame_i, _, _ in batch:
+                    print('-- processed frame %d' % frame_i)
+
+            vid.release()
+            print("-- Finished input stream")
+            for stream in streams:
+                stream.print_stats()
+        except KeyboardInterrupt:
+            # Release the Video Device
+            vid.release()
+            # Message to be displayed after releasing the device
+            print("-- Released Video Resource")
+        finally:
+            for stream in streams:
+                stream.writer.release()
+
+    def process_videos(self, datagen, input_files, **kwargs):
+        """
+        Processes more videos with the same (already loaded) models
+        :param BaseFlowGenerator datagen:
+        :param list input_files:
+        :param kwargs: see process_video
+        """
+        for input_file in input_files:
+            self.process_video(datagen, input_file, **kwargs)
 
     def load_model(self, params):
+        """
+        Registers model and loads its weights for inference, model stays loaded for all processed videos
+        :param dict params: model (BaseModel), weights (path), warp (bool)
+        """
+        params['model'].load_for_inference(params['weights'])
         self._models.append(params)
 
 
@@ -188,8 +539,9 @@ if __name__ == '__main__':
 
         parser.add_argument(
             '-i', '--input',
-            help='Input file',
-            default='/home/mlyko/data/stuttgart_00.mp4'
+            help='Input files',
+            nargs='+',
+            default=['/home/mlyko/data/stuttgart_00.mp4']
         )
 
         parser.add_argument(
@@ -198,6 +550,50 @@ if __name__ == '__main__':
             default=None
         )
 
+        parser.add_argument(
+            '-b', '--batch',
+            help='Batch size of prediction (models without warping)',
+            default=1
+        )
+
+        parser.add_argument(
+            '--pipelined',
+            action='store_true',
+            help='Decodes, preprocesses and writes frames in background threads',
+            default=False
+        )
+
+        parser.add_argument(
+            '--key_interval',
+            help='Warp models run full network on every n-th frame, others are propagated by optical flow '
+                 '(with --key_threshold the largest gap between key frames, unbounded by default)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--key_threshold',
+            help='Adaptive key frames: mean optical flow magnitude (px) from key frame that triggers full network',
+            default=None
+        )
+
+        parser.add_argument(
+            '--norm',
+            help='Normalization of frames used in training [minmax, fixed]',
+            default='minmax'
+        )
+
+        parser.add_argument(
+            '--dtype',
+            help='Type of frames and flow fed to models [float32, float16]',
+            default='float32'
+        )
+
+        parser.add_argument(
+            '--warp_method',
+            help='Implementation of warping in warp models [gather_nd, gather, resampler]',
+            default='gather'
+        )
+
         args = parser.parse_args()
         return args
 
@@ -210,17 +606,27 @@ if __name__ == '__main__':
     videoEvaluator.select_device(args.gid)
 
     datagen = CityscapesFlowGenerator(config.data_path())
+    datagen.set_normalization(args.norm)
+    datagen.set_input_dtype(args.dtype)
 
     videoEvaluator.load_model({
-        'model': ICNet(config.target_size(), datagen.n_classes, for_training=False),
+        'model': ICNet(config.target_size(), datagen.n_classes, for_training=False, input_dtype=args.dtype),
         'weights': config.weights_path() + 'city/rel/ICNet/1612:37e200.b8.lr-0.001000._dec-0.000000.of-farn.h5',
         'warp': False
     })
 
     videoEvaluator.load_model({
-        'model': ICNetWarp0(config.target_size(), datagen.n_classes, for_training=False),
+        'model': ICNetWarp0(config.target_size(), datagen.n_classes, for_training=False, input_dtype=args.dtype,
+                            warp_method=args.warp_method),
         'weights': config.weights_path() + 'city/rel/ICNetWarp0/fin.e150.b8.lr-0.005000._dec-0.000000.of-farn.h5',
         'warp': True
     })
 
-    videoEvaluator.process_video(datagen, args.input)
+    videoEvaluator.process_videos(
+        datagen,
+        args.input,
+        batch_size=int(args.batch),
+        pipelined=args.pipelined,
+        key_interval=int(args.key_interval) if args.key_interval is not None else None,
+        key_threshold=float(args.key_threshold) if args.key_threshold is not None else None
+    )